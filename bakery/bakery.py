@@ -8,26 +8,33 @@ __version__ = '0.4.dev'
 __license__ = 'MIT'
 
 import sys
-import pystache
 import os
 import shutil
 import errno
 import fnmatch
-import markdown
 import codecs
 import re
-import yaml
 import hashlib
 import threading
 import time
-import socket
 import filecmp
-import typogrify
+import minify
+import cache
+import pipeline
+from generations import BuildGenerations
+import weight
 import math
 import copy
+import json
+import glob
+import collections
 from unicodedata import normalize
 from functools import partial
 
+# pystache, markdown, yaml, typogrify and multiprocessing are imported by
+# the functions that need them, so that commands that don't build, like
+# --help and --version, start fast.
+
 # Workaround for the "print is a keyword/function" Python 2/3 dilemma
 # and a fallback for mod_wsgi (resticts stdout/err attribute access)
 # From Bottle.
@@ -49,6 +56,105 @@ def mkdir_p(path):
         else:
             raise
 
+def file_hash(path, block_size=1 << 20):
+    """ Return the md5 hex digest of the file at path.
+    """
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+# Linux ioctl for cloning a file, FICLONE in linux/fs.h.
+_FICLONE = 0x40049409
+
+
+def _copy_data(fsrc, fdst):
+    """ Copy the data of file objects fsrc into fdst.
+
+    Tries a reflink, then copy_file_range and falls back to a streamed
+    copy. Returns the name of the method used.
+    """
+    try:
+        import fcntl
+        fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        return 'reflink'
+    except (ImportError, IOError, OSError):
+        pass
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range is not None:
+        try:
+            while copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                pass
+            return 'copy_file_range'
+        except OSError:
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+    shutil.copyfileobj(fsrc, fdst, 1 << 20)
+    return 'copy'
+
+
+def publish_file(src, dst, link=True):
+    """ Publish src at dst without copying the data if possible.
+
+    A hardlink is used when link is True and src and dst are on the same
+    filesystem, otherwise the data is copied with _copy_data(). The file is
+    replaced with a rename so dst is never seen half written. Returns the
+    name of the method used.
+    """
+    tmp = dst + '.bakery-tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    method = None
+    if link:
+        try:
+            os.link(src, tmp)
+            method = 'link'
+        except (OSError, AttributeError):
+            pass
+    if method is None:
+        with open(src, 'rb') as fsrc:
+            with open(tmp, 'wb') as fdst:
+                method = _copy_data(fsrc, fdst)
+        shutil.copystat(src, tmp)
+    os.rename(tmp, dst)
+    return method
+
+
+def parse_shard(value):
+    """ Parse a shard given as i/N into a tuple of ints.
+
+    >>> parse_shard('0/4')
+    (0, 4)
+    """
+    try:
+        index, shards = [int(v) for v in value.split('/')]
+    except ValueError:
+        raise ValueError('expected i/N, got {0}'.format(value))
+    if shards < 1 or not 0 <= index < shards:
+        raise ValueError('shard {0} out of range'.format(value))
+    return index, shards
+
+
+def shard_of(destination, shards):
+    """ Return the shard a destination hashes into.
+
+    The hash is stable between processes and machines.
+    """
+    if isinstance(destination, unicode):
+        destination = destination.encode('utf-8')
+    return int(hashlib.md5(destination).hexdigest(), 16) % shards
+
+
+def shard_dir(build_dir, index, shards):
+    """ Return the build directory used by a shard.
+    """
+    return '{0}.shard-{1}-of-{2}'.format(build_dir.rstrip(os.sep), index, shards)
+
+_shard_re = re.compile(r'\.shard-\d+-of-\d+$')
+
 # Helper to slugify paths.
 # http://flask.pocoo.org/snippets/5/
 _punct_re = re.compile(r'[\t !"#$%&\'()*\-<=>?@\[\\\]^_`{|},.]+')
@@ -66,8 +172,11 @@ def slugify(text, delim=u'-'):
     return unicode(delim.join(result))
 
 
-class TemplateView(pystache.TemplateSpec):
-    pass
+def template_view():
+    """ Return a new pystache template spec.
+    """
+    import pystache
+    return pystache.TemplateSpec()
 
 
 class Config(object):
@@ -84,6 +193,7 @@ class Config(object):
         if path is not None:
             with codecs.open(path, 'r', encoding='utf-8') as f:
                 content = f.read()
+            import yaml
             c = yaml.load(content)
         if c is not None:
             c.update(config)
@@ -100,6 +210,20 @@ class Config(object):
         self.build_dir = c.get('build_dir', None)
         self.production = c.get('production', False)
         self.pagination = c.get('pagination', {})
+        self.site_partials = c.get('site_partials', [])
+        self.markdown = c.get('markdown', {})
+        self.shard = c.get('shard', None)
+        self.cache_dir = c.get('cache_dir', None)
+        self.cache_size = c.get('cache_size', 1024)
+        self.minify_html = c.get('minify_html', False)
+        self.taxonomies = c.get('taxonomies', {})
+        self.search = c.get('search', False)
+        self.atomic_build = c.get('atomic_build', False)
+        self.keep_builds = c.get('keep_builds', 2)
+        self.workers = c.get('workers') or 1
+        self.threads = c.get('threads', 4)
+        self.queue_size = c.get('queue_size', 64)
+        self.page_weight = c.get('page_weight', False)
 
         self.site_context.update({'production': self.production})
 
@@ -107,13 +231,18 @@ class Config(object):
             self.source_dir = os.getcwd()
         if self.build_dir is None:
             self.build_dir = os.getcwd() + '/_out'
+        if self.cache_dir is None:
+            self.cache_dir = os.getcwd() + '/.bakery-cache'
+        if self.shard is not None:
+            self.build_dir = shard_dir(self.build_dir, *self.shard)
 
 
 class Loader(object):
     """ Content and context loader for resources.
     """
-    def __init__(self, source=''):
+    def __init__(self, source='', cache=None):
         self.source = source
+        self.cache = cache
 
     def load(self, path):
         """ Return content and context from path.
@@ -122,24 +251,183 @@ class Loader(object):
         representing the context extracted from a yaml front matter if 
         present in the content.
         """
-        context = {}
         with codecs.open(self.source + path, 'r', encoding='utf-8') as f:
             content = f.read()
+        return self.parse(content)
+
+    def parse(self, content):
+        """ Return content and context from a string, see load().
+
+        The result is kept in the cache if one was given, so front matter
+        is only parsed again when the content changes.
+        """
+        if self.cache is not None:
+            key = cache.key(content)
+            parsed = self.cache.get_object('frontmatter', key)
+            if parsed is None:
+                parsed = self._parse(content)
+                self.cache.put_object('frontmatter', key, parsed)
+            return parsed
+        return self._parse(content)
+
+    def _parse(self, content):
+        context = {}
         result = re.search(r'^(---\s*\n.*?\n?)^(---\s*$\n?)', content, re.DOTALL|re.MULTILINE)
         if result:
+            import yaml
             front_matter = result.group(1)
             context = yaml.load(front_matter)
             content = content[result.end(0):len(content)]
         return content, context
 
 
+class TemplateCache(object):
+    """ Templates read from disk, kept until their file changes.
+
+    Can be shared between sites that use the same layouts.
+    """
+    def __init__(self):
+        self.templates = {}
+        self.locator = None
+
+    def find(self, name, search_dirs):
+        """ Return the path of the template name in search_dirs.
+        """
+        if self.locator is None:
+            import pystache.locator
+            self.locator = pystache.locator.Locator(extension='html')
+        return self.locator.find_name(name, search_dirs)
+
+    def load(self, path):
+        mtime = os.stat(path).st_mtime
+        cached = self.templates.get(path)
+        if cached is None or cached[0] != mtime:
+            with codecs.open(path, 'r', encoding='utf-8') as f:
+                cached = (mtime, f.read())
+            self.templates[path] = cached
+        return cached[1]
+
+
+# Lines that the renderer indents when a partial is included indented.
+_non_blank_re = re.compile(r'^(.)', re.MULTILINE | re.UNICODE)
+
+
+class Partials(object):
+    """ Partial loader passed to the renderer.
+
+    Partials are site scoped if listed in `site_partials` in the config or
+    if they set `scope: site` in their front matter. A site scoped partial
+    only depends on the site context, it is rendered once per build and
+    spliced into every page that includes it.
+    """
+    def __init__(self, search_dirs, site_scoped=None, templates=None):
+        self.search_dirs = search_dirs
+        self.site_scoped = set(site_scoped or [])
+        self.templates = templates if templates is not None else TemplateCache()
+        self.reset(None, None)
+
+    def reset(self, renderer, site_context):
+        """ Forget templates and rendered partials from a previous build.
+        """
+        self.renderer = renderer
+        self.site_context = site_context
+        self.loaded = {}
+        self.rendered = {}
+        self.indents = {}
+        self.keys = {}
+        self.rendering = set()
+
+    def key(self, name):
+        """ Return the key of name in site._partials, the md5 of the name
+        as it can hold any character.
+        """
+        if name not in self.keys:
+            self.keys[name] = u'p' + hashlib.md5(name.encode('utf-8')).hexdigest()
+        return self.keys[name]
+
+    def load(self, name):
+        if name not in self.loaded:
+            template = self.templates.load(self.templates.find(name, self.search_dirs))
+            self.loaded[name] = Loader().parse(template)
+        return self.loaded[name]
+
+    def get(self, name):
+        if name in self.rendered:
+            return u'{{#site._partials.%(key)s.splice}}\n-\n{{/site._partials.%(key)s.splice}}' % {
+                'key': self.key(name)}
+        template, context = self.load(name)
+        site_scoped = name in self.site_scoped or (context or {}).get('scope') == 'site'
+        # A site scoped partial that includes itself is loaded as a regular
+        # partial while it is being rendered.
+        if not site_scoped or name in self.rendering:
+            return template
+        self.rendering.add(name)
+        try:
+            content = self.renderer.render(template, site=self.site_context)
+        finally:
+            self.rendering.discard(name)
+        self.site_context.setdefault(u'_partials', {})[self.key(name)] = {
+            u'splice': partial(self.splice, name),
+            u'indented': {},
+        }
+        self.rendered[name] = content
+        return self.get(name)
+
+    def splice(self, name, section):
+        """ Return a template that outputs the rendered partial name.
+
+        Called by the renderer for the section returned by get(), section
+        is its line indented like the tag that included the partial. The
+        content is indented the same way, once for each indentation.
+        """
+        indent = section[:len(section) - len(section.lstrip(u' \t'))]
+        key = self.key(name)
+        if (name, indent) not in self.indents:
+            indented = self.site_context[u'_partials'][key][u'indented']
+            content = self.rendered[name]
+            if indent:
+                content = _non_blank_re.sub(indent + u'\\1', content)
+            self.indents[name, indent] = unicode(len(indented))
+            indented[self.indents[name, indent]] = content
+        return u'{{{site._partials.%s.indented.%s}}}' % (key, self.indents[name, indent])
+
+
+# Directory names shared by all resources in them, intern() only takes str.
+_names = {}
+
+
+def _intern(name):
+    return _names.setdefault(name, name)
+
+
 class Resource(object):
     """ Base resource
+
+    Resources use __slots__ and cache the paths derived from source, very
+    large sites hold a lot of them. Assigning source clears the cache.
     """
+    __slots__ = ('config', '_source', '_destination', '_belongs_to', '_belongs_to_parent')
+
     def __init__(self, config, source):
         self.config = config
         self.source = source
 
+    def _get_source(self):
+        return self._source
+
+    def _set_source(self, source):
+        self._source = source
+        self._destination = None
+
+    source = property(_get_source, _set_source)
+
+    def _cache_paths(self):
+        self._destination = destination = self._make_destination()
+        root, last = os.path.split(os.path.dirname(destination))
+        self._belongs_to = _intern(last)
+        parent = os.path.basename(root)
+        self._belongs_to_parent = _intern(parent) if parent else None
+
     def _clean_source(self):
         """ Clears the first directory from the destination path.
         """
@@ -148,23 +436,28 @@ class Resource(object):
             i = self.source[i:].find(os.sep) + 1
         return self.source[i:]
 
+    def _make_destination(self):
+        return self._clean_source()
+
     @property
     def destination(self):
-        return self._clean_source()
+        if self._destination is None:
+            self._cache_paths()
+        return self._destination
     # Alias url to destination
     url = destination
 
     @property
     def belongs_to(self):
-        return os.path.basename(os.path.dirname(self.destination))
+        if self._destination is None:
+            self._cache_paths()
+        return self._belongs_to
 
     @property
     def belongs_to_parent(self):
-        root, last = os.path.split(os.path.dirname(self.destination))
-        parent = os.path.basename(root)
-        if parent == "":
-            parent = None
-        return parent
+        if self._destination is None:
+            self._cache_paths()
+        return self._belongs_to_parent
 
     @property
     def order(self):
@@ -172,14 +465,17 @@ class Resource(object):
 
 
 class PageResource(Resource):
-    def __init__(self, config, source, context=None):
+    __slots__ = ('context', '_id', 'layout_path', 'page_layout_path', 'pager',
+                 'content', 'page_content', 'rendered_content', 'rendered_page')
+
+    def __init__(self, config, source, context=None, loader=None):
         super(PageResource, self).__init__(config, source)
 
         if not context:
             context = {}
 
         self.context = context
-        self.id = hashlib.md5(self.source).hexdigest()
+        self._id = None
         self.layout_path = u'default.html'
         self.page_layout_path = None
         self.pager = None
@@ -187,8 +483,9 @@ class PageResource(Resource):
         self.rendered_content = None
         self.rendered_page = None
 
-        l = Loader(source=config.source_dir)
-        content, context = l.load(self.source)
+        if loader is None:
+            loader = Loader(source=config.source_dir)
+        content, context = loader.load(self.source)
 
         self.context.update(context)
         self.page_content = content
@@ -197,12 +494,17 @@ class PageResource(Resource):
             self.layout_path = self.context['layout']
         if 'page_layout' in self.context:
             self.page_layout_path = self.context['page_layout']
-        if 'title_slug' not in self.context:
-            self.context['title_slug'] = slugify(self.title, delim=u'-')
 
     def __repr__(self):
         return '<PageResource {0}>'.format(self.title)
 
+    @property
+    def id(self):
+        # Pages generated from this one share its id.
+        if self._id is None:
+            self._id = hashlib.md5(self.source).hexdigest()
+        return self._id
+
     def is_markdown(self):
         ext = os.path.splitext(self.source)[1]
         return ext == '.md'
@@ -220,10 +522,14 @@ class PageResource(Resource):
         return self.context.get('title', u'')
 
     @property
-    def destination(self):
+    def title_slug(self):
+        if 'title_slug' in self.context:
+            return self.context['title_slug']
+        return slugify(self.title, delim=u'-')
+
+    def _make_destination(self):
         root, ext = os.path.splitext(self._clean_source())
         return root + u'.html'
-    url = destination
 
     @property
     def order(self):
@@ -231,42 +537,97 @@ class PageResource(Resource):
             return self.context.get('order')
         return self.destination
 
+    def copy_to(self, source):
+        """ Return a copy of this resource with source, used for pages
+        generated from this one. The copy has its own context, values
+        in it are shared.
+        """
+        r = copy.copy(self)
+        r.context = dict(self.context)
+        # The copy keeps the id of this resource.
+        r._id = self.id
+        r.source = source
+        return r
+
     def should_build(self):
         """ Check if this resource should be built out to a html doc.
         """
         return self.context.get('build', True)
 
+    def should_index(self):
+        """ Check if this resource should be added to the search index.
+
+        Pages after the first of a pager and the pages of taxonomy terms
+        repeat what is indexed elsewhere, they are left out unless they
+        set search: true.
+        """
+        search = self.context.get('search')
+        if search is not None:
+            return search
+        if self.pager is not None and self.pager.page > 1:
+            return False
+        return u'term' not in self.context
+
     def build(self):
         """ Build this resource using the passed renderer and optional context.
         """
-        if self.pager is not None:
-            self.context.update({u'pager': self.pager.to_dict()})
-
         dst = self.config.build_dir + os.sep + self.destination
         dst_dir = os.path.dirname(dst)
         if not os.path.exists(dst_dir):
             mkdir_p(dst_dir)
-        with codecs.open(dst, 'w', encoding='utf-8') as f:
-            f.write(self.rendered_page)
+        data = self.rendered_page.encode('utf-8')
+        # Leave an unchanged page as it is, it keeps its mtime and stays
+        # shared with earlier atomic builds.
+        if os.path.isfile(dst) and os.path.getsize(dst) == len(data):
+            with open(dst, 'rb') as f:
+                if f.read() == data:
+                    return
+        # Replace the file, it can be shared with an earlier build.
+        tmp = dst + '.bakery-tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, dst)
+
+    def render(self, renderer, site_context, converter=None, templates=None):
+        """ Render this resource, converter is the markdown.Markdown instance
+        used for articles, one is created for this resource if not passed.
+        Layouts are read through templates, a TemplateCache, if passed.
+        """
+        import typogrify
 
-    def render(self, renderer, site_context):
-        view = TemplateView()
+        if 'title_slug' not in self.context:
+            self.context[u'title_slug'] = self.title_slug
+        if self.pager is not None:
+            self.context.update({u'pager': self.pager.to_dict()})
+
+        view = template_view()
         if self.page_layout_path:
-            view.template_rel_path = self.page_layout
+            if templates is not None:
+                view.template = templates.load(self.page_layout)
+            else:
+                view.template_rel_path = self.page_layout
         else:
             view.template = self.page_content
 
         part = renderer.render(view, self.context, site=site_context)
         if self.is_markdown():
-            part = markdown.markdown(part)
+            if converter is None:
+                import markdown
+                part = markdown.markdown(part)
+            else:
+                converter.reset()
+                part = converter.convert(part)
             part = typogrify.typogrify(part)
 
         page_context = {u'content': part}
         self.rendered_content = part
         page_context.update(self.context)
 
-        view = TemplateView()
-        view.template_rel_path = self.layout
+        view = template_view()
+        if templates is not None:
+            view.template = templates.load(self.layout)
+        else:
+            view.template_rel_path = self.layout
 
         page = renderer.render(view, self.context, page=page_context, site=site_context)
         self.rendered_page = page
@@ -277,20 +638,48 @@ class MediaResource(Resource):
 
     This is a special type of resource that group images into collections based
     on the directory they placed in.
+
+    Metadata and image urls for templates are kept in a dict that is only
+    created when something is bound, and read as attributes.
     """
+    __slots__ = ('_metadata',)
+
     def __init__(self, config, source):
-        super(MediaResource, self).__init__(config, source)
-        self.source = self.source.replace(self.config.source_dir, '', 1)
+        super(MediaResource, self).__init__(config, source.replace(config.source_dir, '', 1))
+        self._metadata = None
 
     def __repr__(self):
         return '<MediaResource {0}>'.format(self.source)
 
+    def __getattr__(self, name):
+        if name == '_metadata':
+            raise AttributeError(name)
+        try:
+            return self._metadata[name]
+        except (KeyError, TypeError):
+            raise AttributeError(name)
+
+    def bind(self, name, value):
+        """ Expose value to templates as name.
+        """
+        if self._metadata is None:
+            self._metadata = {}
+        self._metadata[name] = value
+
     def get_image_url(self, size_name):
         root, ext = os.path.splitext(self.destination)
         path = slugify(root + u'-' + size_name) + ext
         return path 
 
-    def create_image(self, name, size):
+    def create_image(self, name, size, index=None, cache=None):
+        """ Create the image variant name scaled to fit size.
+
+        An existing variant is kept if index, a MediaIndex, has it recorded
+        for the source as it is now. Otherwise it is encoded again and
+        recorded in index. With a cache the variant is kept there by the
+        content of the source and size, so the same image is only encoded
+        once for all sites sharing the cache.
+        """
         try:
             import Image
         except ImportError:
@@ -304,63 +693,460 @@ class MediaResource(Resource):
         dst_dir = os.path.dirname(dst)
         if not os.path.isdir(dst_dir):
             mkdir_p(dst_dir)
-        if not os.path.isfile(dst):
-            try:
-                img = Image.open(src)
+        if os.path.isfile(dst):
+            if index is None:
+                return True
+            entry = index.lookup(src)
+            if entry is not None and name in entry['variants']:
+                return True
+        cached = None
+        if cache is not None:
+            content_hash = index.content_hash(src) if index is not None else file_hash(src)
+            key = cache.key(content_hash, size.get('width'), size.get('height'))
+            ext = os.path.splitext(dst)[1]
+            cached = cache.lookup('images', key, ext)
+        try:
+            img = Image.open(src)
+            original = image_info(img, src)
+            if cached is not None:
+                img = Image.open(cached)
+            else:
                 img.thumbnail((
                     size.get('width'),
                     size.get('height')
                 ), Image.ANTIALIAS)
-                img.save(dst)
-            except Exception, e:
-                _stderr('! Error while processing media "{0}", {1}\n'.format(src, e))
-                return False
+                if cache is not None:
+                    cached = cache.path('images', key, ext)
+                    tmp = '{0}.{1}.tmp{2}'.format(cached, os.getpid(), ext)
+                    img.save(tmp)
+                    os.rename(tmp, cached)
+                else:
+                    tmp = '{0}.bakery-tmp{1}'.format(*os.path.splitext(dst))
+                    img.save(tmp)
+                    os.rename(tmp, dst)
+            if cached is not None:
+                publish_file(cached, dst)
+        except Exception, e:
+            _stderr('! Error while processing media "{0}", {1}\n'.format(src, e))
+            return False
+        if index is not None:
+            width, height = img.size
+            index.record(src, original=original, variant=(name, {
+                'width': width,
+                'height': height,
+                'format': original['format'],
+                'bytes': os.path.getsize(dst),
+                # Variants are saved without EXIF.
+                'orientation': 1,
+            }))
         return True
 
-    def build_original(self):
+    def build_original(self, published=None):
         """ Build this resource with the original media.
+
+        The original is skipped if published, a PublishLedger, shows that
+        it has not changed since it was last published.
         """
         src = os.sep.join([self.config.source_dir, self.source])
         dst = os.sep.join([self.config.build_dir, self.destination])
+        if published is not None and published.is_current(src, dst):
+            return True
         dst_dir = os.path.dirname(dst)
         if not os.path.isdir(dst_dir):
             mkdir_p(dst_dir)
-        shutil.copy2(src, dst)
+        publish_file(src, dst, link=self.config.media.get('publish', 'link') == 'link')
+        if published is not None:
+            published.record(src, dst)
         return True
 
-    def build(self):
+    def index_original(self, index):
+        """ Record the original in index unless it is already there.
+
+        Only the header of the image is read. Media that PIL can not open
+        is recorded with its byte size only.
+        """
+        src = os.sep.join([self.config.source_dir, self.source])
+        entry = index.lookup(src)
+        if entry is not None and entry['original'] is not None:
+            return
+        try:
+            import Image
+            original = image_info(Image.open(src), src)
+        except Exception:
+            original = {'bytes': os.path.getsize(src)}
+        index.record(src, original=original)
+
+    def bind_metadata(self, index, entry=None):
+        """ Expose the metadata in index for this resource to templates, or
+        in entry if given, see planned_entry().
+
+        Sets width, height, format, bytes, orientation and aspect_ratio for
+        the original and `<size name>_image_width`, `_height` and `_bytes`
+        for each image variant.
+        """
+        if entry is None:
+            entry = index.lookup(os.sep.join([self.config.source_dir, self.source]))
+        if entry is None:
+            return
+        for key, value in (entry['original'] or {}).items():
+            self.bind(key, value)
+        if getattr(self, 'width', None) and getattr(self, 'height', None):
+            self.bind('aspect_ratio', round(float(self.width) / self.height, 4))
+        for size_name, variant in entry['variants'].items():
+            for key in ('width', 'height', 'bytes'):
+                if key in variant:
+                    self.bind('%s_image_%s' % (size_name, key), variant[key])
+        candidates = sorted(entry.get('srcset', {}).values(), key=lambda c: c['width'])
+        for attr, webp in (('srcset', False), ('webp_srcset', True)):
+            urls = [u'{0} {1}w'.format(c['url'], c['width'])
+                    for c in candidates if (c['format'] == 'WEBP') == webp]
+            if urls:
+                self.bind(attr, u', '.join(urls))
+
+    def planned_entry(self, index):
+        """ Return the entry build() records in index for this resource,
+        without encoding anything. Only the header of the original is read,
+        the sizes of the variants and srcset candidates are computed and
+        their byte sizes are left out.
+
+        Used for media built by another shard.
+        """
+        self.index_original(index)
+        original = index.lookup(os.sep.join([self.config.source_dir, self.source]))['original']
+        entry = {'original': original, 'variants': {}, 'srcset': {}}
+        if not original.get('width'):
+            # Not an image.
+            return entry
+        size = (original['width'], original['height'])
+        for name, box in self.config.media.get('image', {}).items():
+            width, height = thumbnail_size(size, (box.get('width'), box.get('height')))
+            entry['variants'][name] = {
+                'width': width,
+                'height': height,
+                'format': original['format'],
+                'orientation': 1,
+            }
+        for name, url, width, format in self.srcset_candidates(index):
+            width, height = scaled_size(size, width)
+            entry['srcset'][name] = {
+                'url': url,
+                'width': width,
+                'height': height,
+                'format': format,
+                'orientation': 1,
+            }
+        return entry
+
+    def srcset_candidates(self, index):
+        """ Return (name, url, width, format) for each srcset candidate.
+
+        A candidate is made for each configured width smaller than the
+        original, or the original width if there are none, in the format
+        of the source and as WebP if enabled.
+        """
+        c = self.config.media.get('srcset')
+        if not c:
+            return []
+        self.index_original(index)
+        src = os.sep.join([self.config.source_dir, self.source])
+        original = index.lookup(src)['original']
+        if not original.get('width'):
+            # Not an image.
+            return []
+        widths = [w for w in c.get('widths', []) if w < original['width']]
+        if not widths:
+            widths = [original['width']]
+        candidates = []
+        for width in sorted(set(widths)):
+            name = u'{0}w'.format(width)
+            url = self.get_image_url(name)
+            candidates.append((name, url, width, original['format']))
+            if c.get('webp'):
+                root, ext = os.path.splitext(url)
+                candidates.append((name + u'-webp', root + u'.webp', width, 'WEBP'))
+        return candidates
+
+    def bind_image_urls(self):
+        """ Add a `<size name>_image_url` for each configured image size.
+        """
+        for size_name in self.config.media.get('image', {}):
+            self.bind('%s_image_url' % size_name, partial(self.get_image_url, size_name=size_name))
+
+    def build(self, published=None, index=None, cache=None):
         """ Build this resource.
         """
         if 'image' not in self.config.media:
-            return self.build_original()
-        for size_name, sizes in self.config.media['image'].items():
-            if not self.create_image(size_name, sizes):
+            if not self.build_original(published):
                 return False
-            setattr(self, '%s_image_url' % size_name, partial(self.get_image_url, size_name=size_name))
+            if index is not None:
+                self.index_original(index)
+        else:
+            for size_name, sizes in self.config.media['image'].items():
+                if not self.create_image(size_name, sizes, index, cache):
+                    return False
+            self.bind_image_urls()
+        if index is not None:
+            self.bind_metadata(index)
+        return True
+
+
+def thumbnail_size(size, box):
+    """ Return the size of an image of size after PIL's thumbnail() with
+    box, scaled down to fit keeping its aspect ratio.
+
+    >>> thumbnail_size((400, 300), (100, 100))
+    (100, 75)
+    >>> thumbnail_size((50, 40), (100, 100))
+    (50, 40)
+    """
+    x, y = size
+    if x > box[0]:
+        y = int(max(y * box[0] / x, 1))
+        x = int(box[0])
+    if y > box[1]:
+        x = int(max(x * box[1] / y, 1))
+        y = int(box[1])
+    return x, y
+
+
+def scaled_size(size, width):
+    """ Return the size of an image of size scaled down to width, as
+    srcset candidates are.
+
+    >>> scaled_size((400, 300), 100)
+    (100, 75)
+    >>> scaled_size((80, 60), 100)
+    (80, 60)
+    """
+    if size[0] <= width:
+        return size
+    return width, max(1, int(round(size[1] * float(width) / size[0])))
+
+
+def image_info(img, path):
+    """ Return the metadata recorded for an opened PIL image at path.
+    """
+    orientation = 1
+    try:
+        orientation = (img._getexif() or {}).get(274, 1)
+    except Exception:
+        # Not a JPEG or no readable EXIF.
+        pass
+    width, height = img.size
+    return {
+        'width': width,
+        'height': height,
+        'format': img.format,
+        'bytes': os.path.getsize(path),
+        'orientation': orientation,
+    }
+
+
+def encode_variant(job):
+    """ Encode an image scaled to a width, run in worker processes.
+
+    job is a tuple of source path, destination path, width, format and
+    quality. Returns a tuple of destination and the info recorded in the
+    media index, or None and an error message.
+    """
+    src, dst, width, format, quality = job
+    try:
+        import Image
+        img = Image.open(src)
+        if img.size[0] > width:
+            img = img.resize(scaled_size(img.size, width), Image.ANTIALIAS)
+        if format == 'WEBP' and img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA')
+        tmp = '{0}.{1}.tmp'.format(dst, os.getpid())
+        img.save(tmp, format, quality=quality)
+        os.rename(tmp, dst)
+    except Exception, e:
+        return None, '{0}, {1}'.format(src, e)
+    return dst, {
+        'width': img.size[0],
+        'height': img.size[1],
+        'format': format,
+        'bytes': os.path.getsize(dst),
+        'orientation': 1,
+    }
+
+
+class MediaIndex(object):
+    """ Persistent metadata of media and their image variants.
+
+    Entries are keyed by source path and hold dimensions, format, byte
+    size and EXIF orientation. An entry is only used while the size and
+    mtime of the source match those recorded.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = self._load()
+        self.updated = {}
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except ValueError, e:
+            _stderr('! Ignoring broken media index "{0}", {1}\n'.format(self.path, e))
+            return {}
+
+    def lookup(self, src):
+        """ Return the entry for src or None if missing or out of date.
+        """
+        entry = self.entries.get(src)
+        if entry is None:
+            return None
+        try:
+            st = os.stat(src)
+        except OSError:
+            return None
+        if entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+            return None
+        return entry
+
+    def record(self, src, original=None, variant=None, srcset=None):
+        """ Record the original, a variant and or a srcset candidate. Variants
+        and srcset candidates are given as (name, info).
+        """
+        entry = self.lookup(src)
+        if entry is None:
+            st = os.stat(src)
+            entry = {
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+                'original': None,
+                'variants': {},
+                'srcset': {},
+            }
+            self.entries[src] = entry
+        if original is not None:
+            entry['original'] = original
+        if variant is not None:
+            name, info = variant
+            entry['variants'][name] = info
+        if srcset is not None:
+            name, info = srcset
+            entry.setdefault('srcset', {})[name] = info
+        self.updated[src] = entry
+        return entry
+
+    def content_hash(self, src):
+        """ Return the md5 of src, hashed once for each change of src.
+        """
+        entry = self.lookup(src)
+        if entry is None or not entry.get('hash'):
+            entry = self.record(src)
+            entry['hash'] = file_hash(src)
+        return entry['hash']
+
+    def save(self):
+        """ Write the index, merged with entries saved by others meanwhile.
+        """
+        if not self.updated:
+            return
+        path_dir = os.path.dirname(self.path)
+        if not os.path.isdir(path_dir):
+            mkdir_p(path_dir)
+        entries = self._load()
+        entries.update(self.updated)
+        tmp = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(entries, f)
+        os.rename(tmp, self.path)
+        self.entries = entries
+        self.updated = {}
+
+
+class PublishLedger(object):
+    """ Record of the files published to a build directory.
+
+    Keeps size, mtime and hash of the source for each destination so that
+    unchanged files can be skipped by later builds. Destinations are
+    recorded relative to root, the directory the build is written to.
+    """
+    def __init__(self, path, root):
+        self.path = path
+        self.root = root
+        self.entries = {}
+        if os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except ValueError, e:
+                _stderr('! Ignoring broken ledger "{0}", {1}\n'.format(path, e))
+
+    def is_current(self, src, dst):
+        """ Check if dst was published from src as it is now.
+
+        Size and mtime are compared first, the source is only hashed if
+        the mtime changed but not the size.
+        """
+        entry = self.entries.get(os.path.relpath(dst, self.root))
+        if entry is None:
+            return False
+        try:
+            src_stat = os.stat(src)
+            dst_stat = os.stat(dst)
+        except OSError:
+            return False
+        if dst_stat.st_size != entry['size'] or src_stat.st_size != entry['size']:
+            return False
+        if src_stat.st_mtime == entry['mtime']:
+            return True
+        if file_hash(src) != entry['hash']:
+            return False
+        entry['mtime'] = src_stat.st_mtime
         return True
 
+    def record(self, src, dst):
+        src_stat = os.stat(src)
+        self.entries[os.path.relpath(dst, self.root)] = {
+            'size': src_stat.st_size,
+            'mtime': src_stat.st_mtime,
+            'hash': file_hash(src),
+        }
+
+    def save(self):
+        path_dir = os.path.dirname(self.path)
+        if not os.path.isdir(path_dir):
+            mkdir_p(path_dir)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+        os.rename(tmp, self.path)
+
 
 class ResourceTree(dict):
     def __init__(self, nodes, **kwargs):
         dict.__init__(self, **kwargs)
-        self.build(self, None, nodes)
+        children = {}
+        for n in nodes:
+            children.setdefault(n.belongs_to_parent, []).append(n)
+        self.build(self, None, children, ())
         self[u'all'] = self.all()
 
-    def build(self, tree, parent, nodes):
-        if parent is not None:
-            parent = parent.belongs_to
-        children = [n for n in nodes if n.belongs_to_parent == parent]
-        for child in children:
-            if child.belongs_to not in tree:
-                tree[child.belongs_to] = {u'list': []}
-            if child not in tree[child.belongs_to][u'list']:
-                tree[child.belongs_to][u'list'].append(child)
-                # This key handling... must be able to simplify...
-                tree[child.belongs_to][u'list'] = sorted(
-                    tree[child.belongs_to][u'list'],
-                    key=lambda r: r.order,
-                    reverse=False)
-            self.build(tree[child.belongs_to], child, nodes)
+    def build(self, tree, parent, children, ancestors):
+        """ Add the nodes in children that belongs to parent, a directory
+        name, to tree and recurse into their directories.
+
+        children maps a parent directory name to its nodes, ancestors are
+        the directories above tree and are not entered again.
+        """
+        names = []
+        for child in children.get(parent, []):
+            name = child.belongs_to
+            if name not in tree:
+                tree[name] = {u'list': []}
+                names.append(name)
+            tree[name][u'list'].append(child)
+        ancestors += (parent,)
+        for name in names:
+            tree[name][u'list'].sort(key=lambda r: r.order)
+            if name not in ancestors:
+                self.build(tree[name], name, children, ancestors)
 
     def all(self):
         a = self._all(self, [])
@@ -379,8 +1165,10 @@ class ResourceTree(dict):
 class Pager(object):
     """
     Page the provided list of resources.
+
+    The pages are placed next to host, the first resource if not given.
     """
-    def __init__(self, page, all_resources, config):
+    def __init__(self, page, all_resources, config, host=None):
         self.page = page
         self.config = config
         self.per_page = config.get('per_page', 20)
@@ -394,7 +1182,9 @@ class Pager(object):
         if self.page == self.total_pages:
             stop_index = len(all_resources)
 
-        self.belongs_to, path_tail = os.path.split(all_resources[0].destination)
+        if host is None:
+            host = all_resources[0]
+        self.belongs_to, path_tail = os.path.split(host.destination)
         self.belongs_to += '/' if not self.belongs_to.endswith('/') else ''
 
         self.total_resources = len(all_resources)
@@ -442,73 +1232,187 @@ class Paginator(object):
     def __init__(self, site):
         self.site = site
 
+    @staticmethod
+    def compile(pattern):
+        """ Return the literal prefix of pattern and the pattern compiled.
+
+        The prefix is used to discard most resources with a cheap
+        startswith before the regex is tried.
+        """
+        prefix = re.split(r'[*?\[]', pattern, 1)[0]
+        return prefix, re.compile(fnmatch.translate(pattern))
+
     def paginate(self, config):
-        name, c = config
-        to_paginate = [r for r in self.site.resources if fnmatch.fnmatch(
-            r.destination,
-            c.get('pattern')
-        )]
-        self._paginate(to_paginate, config)
+        self.paginate_all([config])
 
-    def _paginate(self, resources, config):
+    def paginate_all(self, configs):
+        """ Paginate all configs with a single pass over the resources.
+
+        All patterns are matched against the resources as they were before
+        pagination, pages created for one config never match another.
+        """
+        configs = list(configs)
+        matchers = [self.compile(c.get('pattern')) for name, c in configs]
+        to_paginate = [[] for c in configs]
+        for r in self.site.resources:
+            destination = r.destination
+            for (prefix, regex), matched in zip(matchers, to_paginate):
+                if destination.startswith(prefix) and regex.match(destination):
+                    matched.append(r)
+        for config, resources in zip(configs, to_paginate):
+            if resources:
+                self._paginate(resources, config)
+
+    def _paginate(self, resources, config, host=None):
+        """ Page resources, the pager is injected into host and pages
+        after the first are copies of it. host defaults to the first
+        resource.
+        """
         name, c = config
+        if host is None:
+            host = resources[0]
         per_page = c.get('per_page', 20)
         num_pages = Pager.total_pages(resources, per_page)
-        for idx, r in enumerate(resources):
-            #if r.destination.endswith('index.html'):
-            if idx == 0:
-                for page_num in range(1, num_pages + 1):
-                    pager = Pager(page_num, resources, c)
-                    if page_num > 1:
-                        # Create new destination
-                        r_copy = copy.deepcopy(r)
-                        r_copy.pager = pager
-                        path_head, path_tail = os.path.split(r_copy.source)
-                        r_copy.source = path_head + u'/' + pager.pageurl(page_num) + u'/' + path_tail
-                        self.site.resources.append(r_copy)
-                    else:
-                        r.pager = pager
+        for page_num in range(1, num_pages + 1):
+            pager = Pager(page_num, resources, c, host)
+            if page_num > 1:
+                # Create new destination
+                path_head, path_tail = os.path.split(host.source)
+                r_copy = host.copy_to(path_head + u'/' + pager.pageurl(page_num) + u'/' + path_tail)
+                r_copy.pager = pager
+                self.site.add_resource(r_copy)
+            else:
+                host.pager = pager
+
+
+MANIFEST = '.bakery-manifest.json'
+
+
+def search_state_path(cache_dir, build_dir):
+    """ Return the path of the search index state of build_dir.
+    """
+    return os.path.join(cache_dir, 'search',
+                        hashlib.md5(os.path.abspath(build_dir)).hexdigest() + '.json')
+
+
+def new_cache(config):
+    """ Return the cache.Cache configured by config.
+    """
+    max_size = config.cache_size * 1024 * 1024 if config.cache_size else None
+    return cache.Cache(os.path.join(config.cache_dir, 'objects'), max_size)
 
 
 class Site(object):
     """ Represent a Site to be built.
     """
 
-    def __init__(self, config):
+    def __init__(self, config, pool=None, templates=None, cache=None):
+        """ pool, templates and cache can be shared between sites built in
+        the same process, see build_many().
+        """
         self.config = config
+        self.pool = pool
+        # Where the site is published, build_dir points to the generation
+        # being built during an atomic build.
+        self.output_dir = self.config.build_dir
         self.resources = list()
         self.context = self.config.site_context if self.config.site_context else dict()
         self.articles = list()
         self.media = list()
+        self._reset_indexes()
 
-        self.renderer = pystache.Renderer(
-            search_dirs=[
-                self.config.source_dir + os.sep + self.config.paths['layouts'],
-            ],
-            file_extension='html',
-            file_encoding='utf-8',
-            string_encoding='utf-8'
-        )
+        self.search_dirs = [
+            self.config.source_dir + os.sep + self.config.paths['layouts'],
+        ]
+        self.templates = templates if templates is not None else TemplateCache()
+        self.partials = Partials(self.search_dirs, self.config.site_partials, self.templates)
+        self.cache = cache if cache is not None else new_cache(self.config)
+        self.loader = Loader(source=self.config.source_dir, cache=self.cache)
+        self.minifier = minify.Minifier(self.cache) if self.config.minify_html else None
+        self.media_index = MediaIndex(os.path.join(self.config.cache_dir, 'media-index.json'))
+        self._renderer = None
+        self._markdown = None
+        # The resources being rendered by worker processes.
+        self._rendering = None
+        # Sizes of the build when page_weight is enabled.
+        self.weight = None
+        # The search index pages are added to as they are written.
+        self.search_index = None
+
+    @property
+    def renderer(self):
+        """ The pystache renderer, created when first used.
+        """
+        if self._renderer is None:
+            import pystache
+            self._renderer = pystache.Renderer(
+                search_dirs=self.search_dirs,
+                file_extension='html',
+                file_encoding='utf-8',
+                string_encoding='utf-8',
+                partials=self.partials
+            )
+        return self._renderer
 
-    def _new_resource(self, path):
-        """ Internal factory for creating a resource from path.
+    @property
+    def markdown(self):
+        """ The Markdown converter for articles, created when first used.
+        """
+        if self._markdown is None:
+            import markdown
+            self._markdown = markdown.Markdown(**self.config.markdown)
+        return self._markdown
+
+    def _reset_indexes(self):
+        # Built by find_resource(), most builds never look up an id.
+        self._by_id = None
+        self._by_source = {}
+        self._by_destination = {}
+        self._by_directory = {}
+
+    def add_resource(self, resource):
+        """ Add a resource to the site and its lookup indexes.
+        """
+        self.resources.append(resource)
+        self._by_id = None
+        self._by_source[resource.source] = resource
+        destination = resource.destination
+        self._by_destination[destination] = resource
+        self._by_directory.setdefault(os.path.dirname(destination), []).append(resource)
+
+    def remove_resource(self, resource):
+        """ Remove a resource from the site and its lookup indexes.
+        """
+        self.resources.remove(resource)
+        self._by_id = None
+        if self._by_source.get(resource.source) is resource:
+            del self._by_source[resource.source]
+        destination = resource.destination
+        if self._by_destination.get(destination) is resource:
+            del self._by_destination[destination]
+        self._by_directory[os.path.dirname(destination)].remove(resource)
+
+    def _load_resource(self, path):
+        """ Return the resource read from path or None if path is not a
+        resource. Called on the reader threads.
         """
         source_path = path.replace(self.config.source_dir, '', 1)
         if source_path.startswith(u'/_') or source_path.startswith(u'_'):
             return None
-        if source_path.endswith('.md'):
-            a = PageResource(self.config, source=source_path)
-            if 'articles' not in self.context:
-                self.context['articles'] = {}
-            self.articles.append(a)
-            return a
-        elif path.endswith('.html'):
-            r = PageResource(self.config, source=source_path)
-            return r
+        if source_path.endswith('.md') or path.endswith('.html'):
+            return PageResource(self.config, source=source_path, loader=self.loader)
 
     def read_directories(self):
         """ Scan directories for resources.
         """
+        self._read_pages()
+        self._read_media()
+        self._index_pages()
+
+    def _read_pages(self):
+        """ Read the pages, the sources are read and their front matter
+        parsed on threads.
+        """
         page_includes = [
             '*.html',
             '*.md',
@@ -516,19 +1420,41 @@ class Site(object):
         ]
 
         excludes = [
-            os.path.basename(self.config.build_dir),
+            os.path.basename(self.output_dir),
+            os.path.basename(self.output_dir) + '.builds',
             self.config.paths['layouts'],
             self.config.paths['media']
         ]
+        # The build directory, its generations and shards and the cache
+        # can be inside source_dir, by default they are.
+        output = os.path.abspath(_shard_re.sub('', self.output_dir.rstrip(os.sep)))
+        cache_dir = os.path.abspath(self.config.cache_dir)
+
+        def excluded(path):
+            path = os.path.abspath(path)
+            return path == output or path.startswith(output + '.') or path == cache_dir
+
+        paths = []
         for root, dirs, files in os.walk(self.config.source_dir, topdown=True):
-            dirs[:] = [d for d in dirs if d not in excludes]
+            dirs[:] = [d for d in dirs if d not in excludes and not excluded(os.path.join(root, d))]
             for pat in page_includes:
                 for f in fnmatch.filter(files, pat):
-                    r = self._new_resource(os.path.join(root, f))
-                    if r:
-                        # Add resources on the top, this forces childs to be rendered before their parents.
-                        self.resources.insert(0, r)
-        # TODO: Do these things in the loop above instead...
+                    paths.append(os.path.join(root, f))
+        found = []
+        for r in pipeline.threaded_map(self._load_resource, paths,
+                                       self.config.threads, self.config.queue_size):
+            if r is None:
+                continue
+            if r.is_markdown():
+                if 'articles' not in self.context:
+                    self.context['articles'] = {}
+                self.articles.append(r)
+            found.append(r)
+        # Add resources in reverse, this forces childs to be rendered before their parents.
+        for r in reversed(found):
+            self.add_resource(r)
+
+    def _read_media(self):
         for root, dirs, files in os.walk(
                 os.path.join(self.config.source_dir,
                              self.config.paths['media']), topdown=True):
@@ -537,24 +1463,203 @@ class Site(object):
                 m = MediaResource(self.config, os.path.join(root, f))
                 self.media.append(m)
 
+    def _index_pages(self):
+        """ Build the article tree, pagination and taxonomies.
+        """
         self.articles.sort(key=lambda r: len(r.destination))
         self.context['articles'] = ResourceTree(self.articles)
 
         paginator = Paginator(self)
-        for c in self.config.pagination.items():
-            paginator.paginate(c)
+        paginator.paginate_all(self.config.pagination.items())
+        self._build_taxonomies(paginator)
+
+    def _build_taxonomies(self, paginator):
+        """ Index the articles by the terms in their front matter, e.g.
+        tags, in a single pass and create the paginated term pages.
+        """
+        taxonomies = []
+        for name, c in sorted(self.config.taxonomies.items()):
+            taxonomies.append((name, c.get('key', name), {}))
+
+        for a in self.articles:
+            for name, key, terms in taxonomies:
+                values = a.context.get(key)
+                if not values:
+                    continue
+                if isinstance(values, basestring):
+                    values = [values]
+                for value in values:
+                    value = unicode(value)
+                    slug = slugify(value)
+                    term = terms.get(slug)
+                    if term is None:
+                        term = terms[slug] = {
+                            u'name': value,
+                            u'slug': slug,
+                            u'url': None,
+                            u'list': [],
+                        }
+                    # Ignore terms listed twice by the same article.
+                    if not term[u'list'] or term[u'list'][-1] is not a:
+                        term[u'list'].append(a)
+
+        context = {}
+        for name, key, terms in taxonomies:
+            for term in terms.values():
+                term[u'list'].sort(key=lambda r: r.order)
+                term[u'count'] = len(term[u'list'])
+            self._build_term_pages(paginator, name, self.config.taxonomies[name], terms)
+            index = dict(terms)
+            index[u'all'] = sorted(terms.values(), key=lambda t: t[u'slug'])
+            context[name] = index
+        self.context[u'taxonomies'] = context
+
+    def _build_term_pages(self, paginator, name, config, terms):
+        """ Create a page for each term from the page configured for the
+        taxonomy, the page itself is not built.
+        """
+        page = config.get('page')
+        if not page:
+            return
+        template = self.find_by_destination(page)
+        if template is None:
+            _stderr('! No page {0} for taxonomy {1}\n'.format(page, name))
+            return
+        self.remove_resource(template)
+        path = config.get('path', os.path.dirname(page).rstrip(u'/') + u'/{0}/index.html')
+        # The directory the source is in, e.g. /pages.
+        root = template.source[:len(template.source) - len(template._clean_source())]
+        for slug, term in sorted(terms.items()):
+            r = template.copy_to(root + path.format(slug))
+            r.context[u'term'] = term
+            term[u'url'] = r.url
+            self.add_resource(r)
+            paginator._paginate(term[u'list'], (name, config), r)
+
+    def in_shard(self, resource):
+        """ Check if resource should be built by this shard.
+        """
+        if self.config.shard is None:
+            return True
+        index, shards = self.config.shard
+        return shard_of(resource.destination, shards) == index
 
     def _build_media(self):
         failed = []
+        published = PublishLedger(os.path.join(
+            self.config.cache_dir,
+            'published',
+            hashlib.md5(os.path.abspath(self.output_dir)).hexdigest() + '.json'
+        ), self.config.build_dir)
+        # Media built by another shard gets the metadata it will have
+        # there, so site.media is the same in every shard.
+        planned = {}
         for m in self.media:
-            if not m.build():
+            if not self.in_shard(m):
+                planned[m] = m.planned_entry(self.media_index)
+                if 'image' in self.config.media and not planned[m]['original'].get('width'):
+                    # Fails in its shard too, it can't be scaled.
+                    failed.append(m)
+                else:
+                    m.bind_image_urls()
+            elif not m.build(published, self.media_index, self.cache):
                 failed.append(m)
+        self._build_srcsets([m for m in self.media if m not in failed and self.in_shard(m)])
+        for m in self.media:
+            m.bind_metadata(self.media_index, planned.get(m))
+        published.save()
+        self.media_index.save()
         # Remove all resources that we failed to build from media.
         self.media = list(set(self.media).difference(set(failed)))
         #self.media.sort(key=lambda r: len(r.destination))
 
         self.media = sorted(self.media, key=lambda r: r.destination, reverse=True)
         self.context[u'media'] = ResourceTree(self.media)
+        if self.weight is not None:
+            self._measure_media([m for m in self.media if self.in_shard(m)])
+
+    def _measure_media(self, media):
+        """ Record the size of the originals, variants and srcset candidates
+        of media in the weight report.
+        """
+        for m in media:
+            if 'image' in self.config.media:
+                paths = [m.get_image_url(name) for name in self.config.media['image']]
+            else:
+                paths = [m.destination]
+            paths.extend(url for name, url, width, format in m.srcset_candidates(self.media_index))
+            for path in paths:
+                dst = os.sep.join([self.config.build_dir, path.lstrip(os.sep)])
+                if os.path.isfile(dst):
+                    self.weight.add_file('media', self._site_path(dst), os.path.getsize(dst))
+
+    def _build_srcsets(self, media):
+        """ Build the srcset candidates of media.
+
+        Encoded candidates are cached by the content hash of the source,
+        width and quality. Missing ones are encoded in
+        parallel and all are published to the build directory from the
+        cache.
+        """
+        c = self.config.media.get('srcset')
+        if not c:
+            return
+        quality = c.get('quality', 80)
+        pending = []
+        jobs = []
+        for m in media:
+            src = os.sep.join([self.config.source_dir, m.source])
+            entry = self.media_index.lookup(src)
+            recorded = entry.get('srcset', {}) if entry else {}
+            for name, url, width, format in m.srcset_candidates(self.media_index):
+                dst = os.sep.join([self.config.build_dir, url.lstrip(os.sep)])
+                if name in recorded and os.path.isfile(dst):
+                    continue
+                root, ext = os.path.splitext(url)
+                key = cache.key(self.media_index.content_hash(src), width, quality)
+                cached = self.cache.lookup('srcset', key, ext)
+                if cached is None:
+                    cached = self.cache.path('srcset', key, ext)
+                    jobs.append((src, cached, width, format, quality))
+                pending.append((src, name, url, cached, dst))
+        if not pending:
+            return
+
+        # When every candidate is cached the pool is not started.
+        results = []
+        if jobs:
+            _stdout('** Encoding {0} srcset images\n'.format(len(jobs)))
+            import multiprocessing
+            workers = c.get('workers') or multiprocessing.cpu_count()
+            if self.pool is not None:
+                results = self.pool.map(encode_variant, jobs)
+            elif workers > 1 and len(jobs) > 1:
+                pool = multiprocessing.Pool(min(workers, len(jobs)))
+                try:
+                    results = pool.map(encode_variant, jobs)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [encode_variant(job) for job in jobs]
+        encoded = {}
+        for cached, info in results:
+            if cached is None:
+                _stderr('! Error while encoding srcset image {0}\n'.format(info))
+            else:
+                encoded[cached] = info
+
+        import Image
+        for src, name, url, cached, dst in pending:
+            if not os.path.isfile(cached):
+                continue
+            dst_dir = os.path.dirname(dst)
+            if not os.path.isdir(dst_dir):
+                mkdir_p(dst_dir)
+            publish_file(cached, dst)
+            info = encoded.get(cached) or image_info(Image.open(cached), cached)
+            info['url'] = url
+            self.media_index.record(src, srcset=(name, info))
 
     def _build_static(self):
         """ Create directories needed for the structure.
@@ -582,10 +1687,11 @@ class Site(object):
                 srcname = os.path.join(root, f)
                 dstname = srcname.replace(self.config.source_dir, self.config.build_dir, 1)
                 # Copy file if does not exists in build dir or if it has changed.
+                # The copied mtime can lose some precision.
                 if not os.path.exists(dstname) \
                         or os.path.exists(dstname) \
-                        and os.stat(srcname).st_mtime != os.stat(dstname).st_mtime:
-                    shutil.copy2(srcname, dstname)
+                        and abs(os.stat(srcname).st_mtime - os.stat(dstname).st_mtime) > 1e-5:
+                    publish_file(srcname, dstname, link=False)
                     modified_files.append(dstname)
 
         # Compare the asset directory with source to build and remove files
@@ -612,7 +1718,8 @@ class Site(object):
                         except OSError, e:
                             _stderr('** Could not remove file {0} {1}\n'.format(p, e))
 
-        # If compression is enabled run it.
+        # If compression is enabled run it, compressed assets are cached by
+        # their content.
         if self.config.compress:
             import yuicompressor
             _stdout('** With compressing\n')
@@ -620,47 +1727,307 @@ class Site(object):
                 for pat in self.config.compress:
                     for f in fnmatch.filter(files, pat):
                         if not f.endswith('min.js') or not f.endswith('min.css'):
-                            _stdout('>> {0}\n'.format(f))
-                            yuicompressor.run(
-                                os.path.join(root, f),
-                                "-o", os.path.join(root, f)
-                            )
+                            path = os.path.join(root, f)
+                            with open(path, 'rb') as fh:
+                                key = cache.key(fh.read())
+                            ext = os.path.splitext(f)[1]
+                            cached = self.cache.lookup('assets', key, ext)
+                            if cached is None:
+                                _stdout('>> {0}\n'.format(f))
+                                cached = self.cache.path('assets', key, ext)
+                                tmp = '{0}.{1}.tmp{2}'.format(cached, os.getpid(), ext)
+                                yuicompressor.run(path, "-o", tmp)
+                                os.rename(tmp, cached)
+                            publish_file(cached, path, link=False)
+
+        if self.weight is not None:
+            for root, dirs, files in os.walk(asset_dir):
+                for f in files:
+                    path = os.path.join(root, f)
+                    self.weight.add_file('asset', self._site_path(path), os.path.getsize(path))
 
     def build(self):
         """ Build this site and it resources.
+
+        With atomic_build the site is built into a new generation of the
+        build directory that replaces the current one when done, see
+        BuildGenerations.
         """
+        if not self.config.atomic_build or self.config.shard is not None:
+            return self._build()
+        generations = BuildGenerations(self.output_dir, self.config.keep_builds)
+        self.config.build_dir = generations.stage()
+        try:
+            self._build()
+        except:
+            generations.discard()
+            self.search_index = None
+            raise
+        finally:
+            self.config.build_dir = self.output_dir
+        generation = generations.publish()
+        _stdout('** Published {0}\n'.format(generation))
+        if self.search_index is not None:
+            self.search_index.save_state()
+            self.search_index = None
+
+    def _build(self):
         _stdout('** Building site\n')
         # We start fresh on each build.
         self.context = self.config.site_context if self.config.site_context else dict()
         self.resources = list()
         self.articles = list()
         self.media = list()
+        self._reset_indexes()
+        self.cache.reset_stats()
+        self.weight = None
+        if self.config.page_weight:
+            self.weight = weight.WeightReport(
+                [self.config.build_dir, self.config.source_dir], self._budgets())
 
         if not os.path.exists(self.config.build_dir):
             mkdir_p(self.config.build_dir)
 
-        self.read_directories()
-        self._build_media()
-        self._build_static()
-
-        _stdout('** Render resources\n')
-        for r in self.resources:
-            _stdout('>> {0}\n'.format(r.destination))
-            r.render(self.renderer, self.context)
-
-        _stdout('** Building resources\n')
-        for r in self.resources:
-            if r.should_build():
+        # The stages overlap, assets are copied while everything else runs
+        # and pages are read while media is built. Rendering needs the
+        # whole site and starts when both are done, pages are written while
+        # the next ones are rendered.
+        stages = []
+        try:
+            # Assets are not split, the first shard builds all of them.
+            if self.config.shard is None or self.config.shard[0] == 0:
+                stages.append(pipeline.Background(self._build_static))
+            pages = pipeline.Background(self._read_pages)
+            stages.append(pages)
+            self._read_media()
+            self._build_media()
+            pages.wait()
+            self._index_pages()
+
+            resources = [r for r in self.resources if self.in_shard(r)]
+
+            if resources:
+                self.context[u'_partials'] = {}
+                self.partials.reset(self.renderer, self.context)
+
+            self.search_index = self._open_search() if self.config.search else None
+            _stdout('** Render and build resources\n')
+            for r in pipeline.threaded_map(self._write, self._render_all(resources),
+                                           self.config.threads, self.config.queue_size):
+                pass
+            for stage in stages:
+                stage.wait()
+        finally:
+            for stage in stages:
+                stage.join()
+
+        if self.search_index is not None:
+            written = self.search_index.save()
+            _stdout('** Search index {0} pages tokenized, {1} shards written\n'.format(
+                self.search_index.tokenized, written))
+            if self.config.build_dir == self.output_dir:
+                self.search_index.save_state()
+                self.search_index = None
+            # else the state is saved by build() when the generation the
+            # index is in is published.
+
+        if self.config.shard is not None:
+            self.write_manifest()
+
+        self.cache.evict()
+        stats = self.cache.stats()
+        _stdout('** Cache {0} hits, {1} misses, {2:.0%} hit rate\n'.format(
+            stats['hits'], stats['misses'], stats['hit_rate']))
+        for namespace, s in sorted(stats['namespaces'].items()):
+            _stdout('>> {0} {1} hits, {2} misses\n'.format(namespace, s['hits'], s['misses']))
+
+        if self.weight is not None:
+            self._report_weight()
+
+    def _render(self, r):
+        r.render(self.renderer, self.context, self.markdown, self.templates)
+        if self.minifier is not None:
+            r.rendered_page = self.minifier.minify(r.rendered_page)
+
+    def _render_all(self, resources):
+        """ Yield resources as they are rendered, in order.
+
+        With more than one worker the pages are rendered by processes
+        forked from this one, so they share the site as it is now. At most
+        queue_size pages are rendered ahead of the consumer.
+        """
+        global _render_site
+        if self.config.workers < 2 or not hasattr(os, 'fork') or len(resources) < 2:
+            for r in resources:
                 _stdout('>> {0}\n'.format(r.destination))
-                r.build()
+                self._render(r)
+                yield r
+            return
+
+        import multiprocessing
+        # Created before forking so the workers don't import them again.
+        self.renderer
+        self.markdown
+        self._rendering = resources
+        _render_site = self
+        pool = multiprocessing.Pool(self.config.workers, _init_render_worker)
+        try:
+            pending = collections.deque()
+            for i, r in enumerate(resources):
+                pending.append((r, pool.apply_async(_render_in_worker, (i,))))
+                if len(pending) >= self.config.queue_size:
+                    yield self._rendered(*pending.popleft())
+            while pending:
+                yield self._rendered(*pending.popleft())
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            _render_site = None
+            self._rendering = None
+
+    def _rendered(self, r, result):
+        """ Take the result of rendering r in a worker.
+        """
+        r.rendered_page, r.rendered_content, hits, misses = result.get()
+        self.cache.add_stats(hits, misses)
+        _stdout('>> {0}\n'.format(r.destination))
+        return r
+
+    def _write(self, r):
+        """ Write r to the build directory and add it to the search index.
+        Called on the writer threads, the rendered page is dropped once
+        written.
+        """
+        if r.should_build():
+            r.build()
+            if self.weight is not None:
+                dst = self.config.build_dir + os.sep + r.destination
+                self.weight.add_page(self._site_path(dst), os.path.getsize(dst), r.rendered_page)
+            if self.search_index is not None and r.should_index():
+                self.search_index.add(r.url, r.title, r.rendered_content)
+        r.rendered_page = None
+        r.rendered_content = None
+        return r
+
+    def _site_path(self, path):
+        """ Return path, in build_dir, as a path from the site root.
+        """
+        return u'/' + os.path.relpath(path, self.config.build_dir).replace(os.sep, u'/')
+
+    def _budgets(self):
+        c = self.config.page_weight if isinstance(self.config.page_weight, dict) else {}
+        budgets = c.get('budgets') or {}
+        for name in budgets:
+            if name not in weight.BUDGETS:
+                _stderr('! Unknown page weight budget {0}\n'.format(name))
+        return budgets
+
+    def _report_weight(self):
+        """ Write the weight report next to the build directory and raise
+        BudgetExceeded if a budget is exceeded.
+        """
+        c = self.config.page_weight if isinstance(self.config.page_weight, dict) else {}
+        path = c.get('path') or self.output_dir.rstrip(os.sep) + '.weight.json'
+        top = c.get('top', 10)
+        report = self.weight.save(path, top)
+        _stdout('** Page weight {0} pages, {1:.1f} KB in total, report in {2}\n'.format(
+            report['pages'], report['total_bytes'] / 1024.0, path))
+        for page in report['heaviest_pages'][:5]:
+            _stdout('>> {0} {1:.1f} KB, {2:.1f} KB with references\n'.format(
+                page['url'], page['bytes'] / 1024.0, page['total_bytes'] / 1024.0))
+        if report['missing']:
+            _stderr('! {0} referenced files are not in the build, see the report\n'.format(
+                len(report['missing'])))
+        exceeded = report['exceeded']
+        for e in exceeded[:top]:
+            _stderr('! {0} is over the {1} budget, {2} of {3} bytes\n'.format(
+                e['url'], e['budget'], e['bytes'], int(e['limit'])))
+        if len(exceeded) > top:
+            _stderr('! And {0} more over budget, see the report\n'.format(len(exceeded) - top))
+        if exceeded:
+            raise weight.BudgetExceeded(exceeded)
+
+    def _open_search(self):
+        """ Return the search index that the pages of this build are added
+        to, None for sharded builds.
+        """
+        if self.config.shard is not None:
+            _stderr('! The search index is not built by sharded builds\n')
+            return None
+        import search
+        c = self.config.search if isinstance(self.config.search, dict) else {}
+        return search.SearchIndex(
+            os.path.join(self.config.build_dir, c.get('path', u'search')),
+            search_state_path(self.config.cache_dir, self.output_dir),
+            shards=c.get('shards', 16),
+            min_length=c.get('min_length', 2))
+
+    def write_manifest(self):
+        """ Write a manifest of the files in the build directory.
+
+        Used by merge() to combine the output of shards.
+        """
+        files = {}
+        for root, dirs, names in os.walk(self.config.build_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                rel_path = os.path.relpath(path, self.config.build_dir)
+                if rel_path != MANIFEST:
+                    files[rel_path] = os.path.getsize(path)
+        index, shards = self.config.shard
+        with open(os.path.join(self.config.build_dir, MANIFEST), 'w') as f:
+            json.dump({'shard': index, 'shards': shards, 'files': files}, f,
+                      indent=1, sort_keys=True)
 
     def find_resource(self, resource_id):
         """ Return an instance based on the id.
         """
-        for r in self.resources:
-            if r.id == resource_id:
-                return r
-        return None
+        if self._by_id is None:
+            self._by_id = {}
+            # Keep the first resource for an id, pages created by the
+            # paginator share the id of the resource they were copied from.
+            for r in self.resources:
+                self._by_id.setdefault(r.id, r)
+        return self._by_id.get(resource_id)
+
+    def find_by_source(self, source):
+        """ Return the resource read from source, relative to source_dir.
+        """
+        return self._by_source.get(source)
+
+    def find_by_destination(self, destination):
+        """ Return the resource built to destination, relative to build_dir.
+        """
+        return self._by_destination.get(destination)
+
+    def resources_in(self, directory):
+        """ Return the resources built directly into directory.
+        """
+        return list(self._by_directory.get(directory, []))
+
+
+# The site rendered by the worker processes, set before they are forked.
+_render_site = None
+
+
+def _init_render_worker():
+    """ Set up a worker process forked from the build.
+    """
+    # The worker is forked while other stages run, a thread of one of
+    # them may have held the cache lock and it would never be released.
+    _render_site.cache.lock = threading.Lock()
+
+
+def _render_in_worker(index):
+    """ Render a resource of _render_site, runs in a worker process.
+    """
+    site = _render_site
+    r = site._rendering[index]
+    site.cache.reset_stats()
+    site._render(r)
+    content = r.rendered_content if site.config.search else None
+    return r.rendered_page, content, site.cache.hits, site.cache.misses
 
 
 class ResourceMonitor(threading.Thread):
@@ -737,6 +2104,153 @@ def build(config_path, **config):
     site.build()
 
 
+class SharedPool(object):
+    """ A pool of worker processes shared by the sites of build_many(),
+    started when a site first maps work to it.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self._pool = None
+
+    def map(self, func, items):
+        if self._pool is None:
+            import multiprocessing
+            self._pool = multiprocessing.Pool(self.workers)
+        return self._pool.map(func, items)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def build_many(config_paths, workers=None, **config):
+    """ Build several sites in one process.
+
+    The sites share the templates read from disk, the cache when their
+    cache_dir is the same and a pool for encoding media, by default of one
+    process per cpu. If given, workers is also the number of processes
+    rendering the pages of each site. Returns a list of
+    (config_path, seconds, pages, media, error) for each site.
+    """
+    import multiprocessing
+    if workers:
+        config['workers'] = workers
+    workers = workers or multiprocessing.cpu_count()
+    pool = SharedPool(workers) if workers > 1 else None
+    templates = TemplateCache()
+    caches = {}
+    timings = []
+    try:
+        for config_path in config_paths:
+            start = time.time()
+            pages = media = 0
+            error = None
+            try:
+                c = Config(config_path, **config)
+                _stdout('Building {0} to {1}\n'.format(config_path, c.build_dir))
+                cache_dir = os.path.abspath(c.cache_dir)
+                if cache_dir not in caches:
+                    caches[cache_dir] = new_cache(c)
+                site = Site(c, pool=pool, templates=templates, cache=caches[cache_dir])
+                site.build()
+                pages, media = len(site.resources), len(site.media)
+            except Exception, e:
+                _stderr('! Failed to build {0}, {1}\n'.format(config_path, e))
+                error = str(e)
+            timings.append((config_path, time.time() - start, pages, media, error))
+    finally:
+        if pool is not None:
+            pool.close()
+
+    _stdout('\n{0:<40} {1:>9} {2:>7} {3:>7}\n'.format('config', 'seconds', 'pages', 'media'))
+    for config_path, seconds, pages, media, error in timings:
+        _stdout('{0:<40} {1:>9.2f} {2:>7} {3:>7}{4}\n'.format(
+            config_path, seconds, pages, media, ' failed' if error else ''))
+    _stdout('{0:<40} {1:>9.2f}\n'.format('total', sum(t[1] for t in timings)))
+    return timings
+
+
+def merge(config_path, **config):
+    """ Merge the output of all shards into the build directory.
+
+    Returns False without touching the build directory if shards are
+    missing or a destination was produced by more than one shard.
+    """
+    c = Config(config_path, **config)
+    manifests = []
+    for path in sorted(glob.glob(shard_dir(c.build_dir, '*', '*'))):
+        if not _shard_re.search(path):
+            # Such as the page weight report of a shard.
+            continue
+        manifest_path = os.path.join(path, MANIFEST)
+        if not os.path.isfile(manifest_path):
+            _stderr('! No manifest in {0}, skipping\n'.format(path))
+            continue
+        with open(manifest_path) as f:
+            manifests.append((path, json.load(f)))
+
+    if not manifests:
+        _stderr('! No shards found for {0}\n'.format(c.build_dir))
+        return False
+    shards = set(m['shards'] for path, m in manifests)
+    if len(shards) != 1:
+        _stderr('! Shards from different builds: {0}\n'.format(sorted(shards)))
+        return False
+    shards = shards.pop()
+    found = sorted(m['shard'] for path, m in manifests)
+    if found != range(shards):
+        _stderr('! Expected shards 0 to {0}, found {1}\n'.format(shards - 1, found))
+        return False
+
+    produced = {}
+    duplicates = []
+    for path, m in manifests:
+        for rel_path in m['files']:
+            if rel_path in produced:
+                duplicates.append((rel_path, produced[rel_path], path))
+            produced[rel_path] = path
+    for rel_path, first, second in sorted(duplicates):
+        _stderr('! {0} produced by both {1} and {2}\n'.format(rel_path, first, second))
+    if duplicates:
+        return False
+
+    _stdout('Merging {0} shards into {1}\n'.format(shards, c.build_dir))
+    build_dir = c.build_dir
+    if c.atomic_build:
+        generations = BuildGenerations(c.build_dir, c.keep_builds)
+        build_dir = generations.stage()
+    for rel_path, path in sorted(produced.items()):
+        dst = os.path.join(build_dir, rel_path)
+        dst_dir = os.path.dirname(dst)
+        if not os.path.isdir(dst_dir):
+            mkdir_p(dst_dir)
+        publish_file(os.path.join(path, rel_path), dst, link=False)
+    if c.atomic_build:
+        generations.publish()
+    return True
+
+
+def rollback(config_path, **config):
+    """ Make the previous build of an atomic build directory current.
+    """
+    c = Config(config_path, **config)
+    generation = BuildGenerations(c.build_dir, c.keep_builds).rollback()
+    if generation is None:
+        _stderr('! No earlier build of {0} to roll back to\n'.format(c.build_dir))
+        return False
+    _stdout('Rolled back {0} to {1}\n'.format(c.build_dir, generation))
+    # The search index state is of the build rolled back from, the next
+    # build tokenizes every page again.
+    try:
+        os.remove(search_state_path(c.cache_dir, c.build_dir))
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    return True
+
+
 def serve(config_path, port=8000, **config):
     c = Config(config_path, **config)
 
@@ -744,10 +2258,14 @@ def serve(config_path, port=8000, **config):
     c.build_dir = os.path.abspath(c.build_dir)
 
     site = Site(c)
-    site.build()
+    try:
+        site.build()
+    except weight.BudgetExceeded:
+        pass
 
     mkdir_p(c.build_dir)
 
+    import socket
     import SimpleHTTPServer
     import SocketServer
 
@@ -755,7 +2273,11 @@ def serve(config_path, port=8000, **config):
         allow_reuse_address = True
 
     class RequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
-        pass
+        def translate_path(self, path):
+            # Resolve the path in build_dir on each request, so the latest
+            # build is served when build_dir is replaced.
+            path = SimpleHTTPServer.SimpleHTTPRequestHandler.translate_path(self, path)
+            return os.path.join(c.build_dir, os.path.relpath(path, os.getcwd()))
 
     try:
         server = Server(('', port), RequestHandler)
@@ -768,15 +2290,18 @@ def serve(config_path, port=8000, **config):
         for p in modified_paths:
             _stdout('Changed {0}\n'.format(p))
         # TODO: Pass the modified paths
-        site.build()
+        try:
+            site.build()
+        except weight.BudgetExceeded:
+            pass
 
     paths = [os.path.join(c.source_dir, p) for p in c.paths]
 
     monitor = ResourceMonitor(paths, rebuild)
     monitor.start()
 
-    # Run server from our build directory.
-    os.chdir(c.build_dir)
+    # Run server next to our build directory, which may be replaced.
+    os.chdir(os.path.dirname(c.build_dir))
 
     _stdout('Running webserver at 0.0.0.0:%s for %s\n' % (port, c.build_dir))
     _stdout('Type control-c to exit\n')
@@ -796,6 +2321,11 @@ def main():
     _opt("-p", "--port", action="store", help="set port for webserver [default: %default].", default=8000, dest="port")
     _opt("--bootstrap", action="store_true", help="create a new site here.")
     _opt("--build", action="store_true", help="build this site.")
+    _opt("--shard", action="store", help="build only shard i of N, given as i/N.")
+    _opt("--merge", action="store_true", help="merge the output of all shards.")
+    _opt("--rollback", action="store_true", help="make the previous atomic build current.")
+    _opt("--batch", action="store_true", help="build all sites given by the config paths in args in one process.")
+    _opt("--workers", action="store", type="int", help="number of processes rendering pages [default: 1], with --batch also the size of the pool encoding media [default: number of cpus].")
     _opt("--debug", action="store_true", help="set debug mode.")
     _opt("--no-compress", action="store_true", help="do not compress css and js.", dest="no_compress", default=False)
     _cmd_options, _cmd_args = _cmd_parser.parse_args()
@@ -816,7 +2346,35 @@ def main():
             sys.exit(1)
         serve(opt.config, port, no_compress=opt.no_compress)
     elif opt.build:
-        build(opt.config, no_compress=opt.no_compress)
+        shard = None
+        if opt.shard:
+            try:
+                shard = parse_shard(opt.shard)
+            except ValueError, e:
+                _stderr('Invalid value for shard: {0}\n'.format(e))
+                sys.exit(1)
+        options = {}
+        if opt.workers:
+            options['workers'] = opt.workers
+        try:
+            build(opt.config, no_compress=opt.no_compress, shard=shard, **options)
+        except weight.BudgetExceeded, e:
+            _stderr('Build failed, {0}\n'.format(e))
+            sys.exit(1)
+        sys.exit(0)
+    elif opt.batch:
+        if not args:
+            _stderr('Error: --batch needs one or more config paths.\n')
+            sys.exit(1)
+        timings = build_many(args, workers=opt.workers, no_compress=opt.no_compress)
+        sys.exit(1 if any(t[4] for t in timings) else 0)
+    elif opt.merge:
+        if not merge(opt.config, no_compress=opt.no_compress):
+            sys.exit(1)
+        sys.exit(0)
+    elif opt.rollback:
+        if not rollback(opt.config, no_compress=opt.no_compress):
+            sys.exit(1)
         sys.exit(0)
     else:
         parser.print_help()
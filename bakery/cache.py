@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+"""
+A content addressed cache kept between builds.
+
+Entries are files grouped by namespace, e.g. media variants or parsed
+front matter, and named by a hash of whatever they were made from. The
+cache can be shared between branches, sites and CI runs by pointing them
+at the same directory. When the cache grows beyond its size budget the
+least recently used entries are removed.
+"""
+
+from __future__ import with_statement
+
+import os
+import errno
+import hashlib
+import threading
+import cPickle as pickle
+
+
+def key(*parts):
+    """Returns a cache key for parts.
+
+    >>> key(u'a', 1) == key(u'a', 1)
+    True
+    >>> key(u'a', 1) == key(u'a1')
+    False
+    """
+    h = hashlib.md5()
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        h.update(str(len(str(part))) + ':' + str(part))
+    return h.hexdigest()
+
+
+class Cache(object):
+    """Content addressed file cache with a size budget.
+
+    max_size is the budget in bytes, None for no limit. The cache can be
+    used from several threads.
+    """
+    key = staticmethod(key)
+
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = {}
+        self.misses = {}
+        self.lock = threading.Lock()
+
+    def path(self, namespace, key, suffix=''):
+        """Returns the path of an entry, creating its directory.
+
+        Use this to write an entry directly, write to a temporary name in
+        the same directory and rename it into place.
+        """
+        path = os.path.join(self.directory, namespace, key[:2], key + suffix)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        return path
+
+    def lookup(self, namespace, key, suffix=''):
+        """Returns the path of an entry or None if it is not cached.
+        """
+        path = self.path(namespace, key, suffix)
+        try:
+            # Mark the entry as recently used.
+            os.utime(path, None)
+        except OSError:
+            self.add_stats(misses={namespace: 1})
+            return None
+        self.add_stats(hits={namespace: 1})
+        return path
+
+    def get(self, namespace, key, suffix=''):
+        """Returns the data of an entry or None if it is not cached.
+        """
+        path = self.lookup(namespace, key, suffix)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def put(self, namespace, key, data, suffix=''):
+        """Stores data in an entry and returns its path.
+        """
+        path = self.path(namespace, key, suffix)
+        tmp = '{0}.{1}.{2}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+        return path
+
+    def get_object(self, namespace, key):
+        data = self.get(namespace, key, '.pickle')
+        if data is None:
+            return None
+        try:
+            return pickle.loads(data)
+        except Exception:
+            return None
+
+    def put_object(self, namespace, key, obj):
+        return self.put(namespace, key, pickle.dumps(obj, 2), '.pickle')
+
+    def entries(self):
+        """Returns a list of (mtime, size, path) for each entry.
+        """
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            for f in files:
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is within
+        its budget. Returns the number of entries removed.
+        """
+        if self.max_size is None:
+            return 0
+        entries = self.entries()
+        size = sum(e[1] for e in entries)
+        removed = 0
+        for mtime, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+            removed += 1
+        return removed
+
+    def stats(self):
+        """Returns hits, misses and hit rate in total and per namespace.
+        """
+        def rate(hits, misses):
+            total = hits + misses
+            return float(hits) / total if total else 0.0
+        namespaces = {}
+        for namespace in set(self.hits) | set(self.misses):
+            hits = self.hits.get(namespace, 0)
+            misses = self.misses.get(namespace, 0)
+            namespaces[namespace] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': rate(hits, misses),
+            }
+        hits = sum(self.hits.values())
+        misses = sum(self.misses.values())
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': rate(hits, misses),
+            'namespaces': namespaces,
+        }
+
+    def add_stats(self, hits=None, misses=None):
+        """Adds hits and misses per namespace, e.g. counted by another
+        process.
+        """
+        with self.lock:
+            for counts, added in ((self.hits, hits), (self.misses, misses)):
+                for namespace, n in (added or {}).items():
+                    counts[namespace] = counts.get(namespace, 0) + n
+
+    def reset_stats(self):
+        self.hits = {}
+        self.misses = {}
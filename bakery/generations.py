@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""
+Double buffered build output.
+
+The build directory is a symlink to the current generation of the build
+in <build_dir>.builds. Each build is made in a new generation and
+published by switching the symlink, see BuildGenerations.
+"""
+
+import os
+import errno
+import shutil
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _link_tree(src, dst):
+    """ Recreate the tree src at dst with hardlinks to its files.
+    """
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        _makedirs(target)
+        for name in list(dirs):
+            if os.path.islink(os.path.join(root, name)):
+                dirs.remove(name)
+                files.append(name)
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(target, name))
+            else:
+                os.link(path, os.path.join(target, name))
+
+
+class BuildGenerations(object):
+    """ Double buffered build output.
+
+    build_dir is a symlink to the current generation in
+    <build_dir>.builds. A build is made in a new generation that starts as
+    hardlinks to the files of the current one, and is published by
+    replacing the symlink with a rename, so readers see either the old or
+    the new build. keep generations are kept, including the current one,
+    for rollback().
+
+    Files in a generation are shared with the one it was staged from and
+    must be replaced, never written in place.
+    """
+    def __init__(self, build_dir, keep=2):
+        self.path = os.path.abspath(build_dir).rstrip(os.sep)
+        self.directory = self.path + '.builds'
+        self.keep = max(keep, 1)
+        self.staging = None
+        self.number = None
+
+    def generations(self):
+        """ Return the published generations, oldest first.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(g for g in os.listdir(self.directory) if g.isdigit())
+
+    def current(self):
+        """ Return the name of the current generation or None.
+        """
+        if not os.path.islink(self.path):
+            return None
+        return os.path.basename(os.path.realpath(self.path))
+
+    def _generation(self, number):
+        return os.path.join(self.directory, '%06d' % number)
+
+    def stage(self):
+        """ Create a new generation from the current output and return
+        its path.
+        """
+        _makedirs(self.directory)
+        # Remove what is left from builds that did not finish.
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp'):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        generations = self.generations()
+        self.number = int(generations[-1]) + 1 if generations else 1
+        if os.path.isdir(self.path) and not os.path.islink(self.path):
+            # A plain build directory becomes the generation before this.
+            self.number += 1
+        self.staging = self._generation(self.number) + '.tmp'
+        if os.path.isdir(self.path):
+            _link_tree(os.path.realpath(self.path), self.staging)
+        else:
+            _makedirs(self.staging)
+        return self.staging
+
+    def discard(self):
+        shutil.rmtree(self.staging, ignore_errors=True)
+        self.staging = None
+
+    def _point_to(self, generation):
+        link = self.path + '.bakery-tmp'
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.relpath(generation, os.path.dirname(self.path)), link)
+        os.rename(link, self.path)
+
+    def publish(self):
+        """ Make the staged generation the current one.
+        """
+        generation = self._generation(self.number)
+        os.rename(self.staging, generation)
+        self.staging = None
+        if os.path.isdir(self.path) and not os.path.islink(self.path):
+            # A directory can't be replaced by a rename, this is the only
+            # time build_dir is briefly missing.
+            os.rename(self.path, self._generation(self.number - 1))
+        self._point_to(generation)
+        self.prune()
+        return generation
+
+    def prune(self):
+        """ Remove the oldest generations beyond keep.
+        """
+        current = self.current()
+        others = [g for g in self.generations() if g != current]
+        for name in others[:max(len(others) - (self.keep - 1), 0)]:
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def rollback(self):
+        """ Make the generation before the current one current. Returns
+        its path, or None if there is none.
+
+        The generations after it are removed, so later builds are staged
+        from it and prune() and rollback() never go back to a build that
+        was rolled back from.
+        """
+        current = self.current()
+        generations = self.generations()
+        older = [g for g in generations if current is None or g < current]
+        if not older:
+            return None
+        generation = os.path.join(self.directory, older[-1])
+        self._point_to(generation)
+        for name in generations[len(older):]:
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        return generation
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+HTML minification for rendered pages.
+
+Collapses whitespace in text and removes comments while leaving tags and
+the contents of ``<pre>``, ``<textarea>``, ``<script>`` and ``<style>``
+as they are.
+"""
+
+import re
+import hashlib
+
+_token_re = re.compile(r"""
+    (?P<comment><!--.*?-->)
+    | (?P<raw><(?P<tag>pre|textarea|script|style)\b[^>]*>.*?</(?P=tag)\s*>)
+    | (?P<element><[^>]*>)
+    """, re.DOTALL | re.IGNORECASE | re.VERBOSE)
+
+_space_re = re.compile(r'\s+')
+
+
+def _collapse(match):
+    return '\n' if '\n' in match.group(0) else ' '
+
+
+def iter_minify(html):
+    """Yields the minified html in chunks.
+
+    Runs of whitespace are collapsed into a single space, or a newline if
+    the run contained one.
+
+    >>> u''.join(iter_minify(u'<p>\\n  Hello   world\\n</p>'))
+    u'<p>\\nHello world\\n</p>'
+
+    Comments are removed, conditional comments are kept.
+
+    >>> u''.join(iter_minify(u'<p>a<!-- note -->b</p><!--[if IE]><p>IE</p><![endif]-->'))
+    u'<p>ab</p><!--[if IE]><p>IE</p><![endif]-->'
+
+    Tags and the contents of pre, textarea, script and style are left alone.
+
+    >>> u''.join(iter_minify(u'<pre>  a\\n  b</pre>  <script>var a  =  1; // <!-- x --></script>'))
+    u'<pre>  a\\n  b</pre> <script>var a  =  1; // <!-- x --></script>'
+    >>> u''.join(iter_minify(u'<a   title="two  spaces">x</a>'))
+    u'<a   title="two  spaces">x</a>'
+    """
+    pos = 0
+    for match in _token_re.finditer(html):
+        if match.start() > pos:
+            yield _space_re.sub(_collapse, html[pos:match.start()])
+        pos = match.end()
+        comment = match.group('comment')
+        if comment is None:
+            yield match.group(0)
+        elif comment.startswith('<!--[if') or comment.startswith('<!--<![endif'):
+            yield comment
+    if pos < len(html):
+        yield _space_re.sub(_collapse, html[pos:])
+
+
+def minify(html):
+    """Returns html minified, see iter_minify().
+
+    >>> minify(u'<ul>\\n    <li>One</li>\\n    <li>Two</li>\\n</ul>\\n')
+    u'<ul>\\n<li>One</li>\\n<li>Two</li>\\n</ul>\\n'
+    """
+    return u''.join(iter_minify(html))
+
+
+class Minifier(object):
+    """Minifies html and caches the result by the hash of its content in
+    cache, a bakery.cache.Cache, if given.
+
+    Nothing is kept in memory, pages are rarely minified twice in a build.
+    """
+    def __init__(self, cache=None):
+        self.cache = cache
+
+    def minify(self, html):
+        if self.cache is None:
+            return minify(html)
+        key = hashlib.md5(html.encode('utf-8')).hexdigest()
+        result = self.cache.get('minify', key)
+        if result is not None:
+            return result.decode('utf-8')
+        result = minify(html)
+        self.cache.put('minify', key, result.encode('utf-8'))
+        return result
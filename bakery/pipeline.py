@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""
+Building blocks for running the stages of a build at the same time.
+
+Stages are connected by generators. threaded_map() runs a stage on
+threads, suitable for reading and writing files, and keeps a bounded
+number of items in flight so that a slow stage holds back the ones that
+feed it instead of letting work pile up in memory. Background runs a
+stage that has no output, like copying assets, next to the others.
+"""
+
+import sys
+import threading
+import collections
+import Queue
+
+
+class _Result(object):
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def get(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+
+def threaded_map(func, items, threads=4, size=64):
+    """Yields func(item) for each of items in order, func is called on
+    threads.
+
+    At most size items are queued or done but not yet yielded, items is
+    only iterated as the results are consumed. An exception raised by func
+    is raised when its result is reached.
+
+    >>> list(threaded_map(lambda x: x * 2, range(10), threads=3, size=2))
+    [0, 2, 4, 6, 8, 10, 12, 14, 16, 18]
+    """
+    if threads < 2:
+        for item in items:
+            yield func(item)
+        return
+
+    todo = Queue.Queue(size)
+
+    def work():
+        while True:
+            task = todo.get()
+            if task is None:
+                return
+            item, result = task
+            try:
+                result.value = func(item)
+            except BaseException:
+                result.error = sys.exc_info()
+            result.done.set()
+
+    workers = []
+    for i in range(threads):
+        worker = threading.Thread(target=work)
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    pending = collections.deque()
+    try:
+        for item in items:
+            result = _Result()
+            todo.put((item, result))
+            pending.append(result)
+            if len(pending) >= size:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        for worker in workers:
+            todo.put(None)
+        for worker in workers:
+            worker.join()
+
+
+class Background(threading.Thread):
+    """Runs func(*args) on a thread, wait() raises what it raised.
+
+    >>> stage = Background(sum, [1, 2, 3])
+    >>> stage.wait()
+    6
+    """
+    def __init__(self, func, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except BaseException:
+            self.error = sys.exc_info()
+
+    def wait(self):
+        self.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+        return self.result
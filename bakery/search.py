@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+"""
+A static search index built from the rendered pages.
+
+The index is an inverted index split into shards by a hash of the term,
+so a client only fetches the shards for the terms it searches for.
+
+    search/index.json   documents and number of shards
+    search/07.json      terms of shard 7, {term: [offset, length, df]}
+    search/07.bin       postings of shard 7
+
+``index.json`` holds ``docs``, a list of ``[url, title]`` indexed by
+document id where removed documents are null. The postings of a term are
+pairs of document id delta and term frequency, ascending by document id,
+encoded as unsigned LEB128 varints. A client lower cases the query,
+splits it like tokenize() and picks shards with shard_of().
+
+Term counts are kept per page between builds. Pages whose content did not
+change are not tokenized again and only the shards holding terms of
+changed pages are written.
+"""
+
+from __future__ import with_statement
+
+import os
+import re
+import json
+import errno
+import hashlib
+import threading
+from HTMLParser import HTMLParser
+
+VERSION = 1
+
+_tag_re = re.compile(r'<(script|style)\b.*?</\1\s*>|<[^>]*>', re.DOTALL | re.IGNORECASE)
+_word_re = re.compile(r'\w+', re.UNICODE)
+_unescape = HTMLParser().unescape
+
+
+def tokenize(html, min_length=2, max_length=32):
+    """Yields the words of html, lower cased and without markup.
+
+    >>> list(tokenize(u'<h1>Hello&nbsp;World</h1><p>A <em>big</em> &amp; small <span class="caps">CSS</span> tip.</p>'))
+    [u'hello', u'world', u'big', u'small', u'css', u'tip']
+    >>> list(tokenize(u'<script>var x = 1;</script>Caf\\xe9'))
+    [u'caf\\xe9']
+    """
+    text = _unescape(_tag_re.sub(u' ', html))
+    for word in _word_re.findall(text.lower()):
+        if min_length <= len(word) <= max_length:
+            yield word
+
+
+def shard_of(term, shards):
+    """Returns the shard of term, the FNV-1a hash of its UTF-8 bytes
+    modulo shards.
+
+    >>> shard_of(u'hello', 16)
+    11
+    """
+    h = 0x811c9dc5
+    for c in bytearray(term.encode('utf-8')):
+        h = ((h ^ c) * 0x01000193) & 0xffffffff
+    return h % shards
+
+
+def encode_postings(postings):
+    """Returns postings, a sorted list of (doc id, term frequency), encoded
+    as varints.
+
+    >>> decode_postings(encode_postings([(3, 1), (200, 2), (201, 1)]))
+    [(3, 1), (200, 2), (201, 1)]
+    """
+    data = bytearray()
+    previous = 0
+    for doc, tf in postings:
+        for n in (doc - previous, tf):
+            while n > 0x7f:
+                data.append((n & 0x7f) | 0x80)
+                n >>= 7
+            data.append(n)
+        previous = doc
+    return bytes(data)
+
+
+def decode_postings(data):
+    numbers = []
+    n = shift = 0
+    for b in bytearray(data):
+        n |= (b & 0x7f) << shift
+        shift += 7
+        if not b & 0x80:
+            numbers.append(n)
+            n = shift = 0
+    postings = []
+    doc = 0
+    for i in range(0, len(numbers), 2):
+        doc += numbers[i]
+        postings.append((doc, numbers[i + 1]))
+    return postings
+
+
+def _write(path, data):
+    tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+
+class SearchIndex(object):
+    """Collects pages and writes the sharded index to directory.
+
+    The term counts of each page are kept in state_path between builds.
+    Call add() for every page in the build, then save() and, once the
+    index is where the next build starts from, save_state(). Pages can be
+    added from several threads.
+    """
+    def __init__(self, directory, state_path, shards=16, min_length=2):
+        self.directory = directory
+        self.state_path = state_path
+        self.shards = shards
+        self.min_length = min_length
+        self.docs = {}
+        self.next_id = 0
+        self.seen = set()
+        self.dirty = set()
+        self.docs_changed = False
+        self.tokenized = 0
+        self._term_shards = {}
+        self.lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            state = None
+        if not state or state.get('version') != VERSION \
+                or state.get('shards') != self.shards \
+                or state.get('min_length') != self.min_length:
+            # Nothing to reuse, everything is written.
+            self.dirty = set(range(self.shards))
+            self.docs_changed = True
+            return
+        self.docs = state['docs']
+        self.next_id = state['next_id']
+
+    def _shard(self, term):
+        shard = self._term_shards.get(term)
+        if shard is None:
+            shard = self._term_shards[term] = shard_of(term, self.shards)
+        return shard
+
+    def _shards_of(self, terms):
+        return set(self._shard(t) for t in terms)
+
+    def add(self, url, title, content):
+        """Adds or updates the page at url, content is its html.
+        """
+        content_hash = hashlib.md5(content.encode('utf-8')).hexdigest()
+        with self.lock:
+            self.seen.add(url)
+            doc = self.docs.get(url)
+            if doc is not None and doc['hash'] == content_hash:
+                if doc['title'] != title:
+                    doc['title'] = title
+                    self.docs_changed = True
+                return
+        terms = {}
+        for word in tokenize(content, self.min_length):
+            terms[word] = terms.get(word, 0) + 1
+        with self.lock:
+            self._update(url, title, content_hash, terms)
+
+    def _update(self, url, title, content_hash, terms):
+        self.tokenized += 1
+        doc = self.docs.get(url)
+        if doc is None:
+            # Ids of new pages are given by save(), in order of url, so
+            # they don't depend on the order pages are added in.
+            doc = self.docs[url] = {'id': None, 'terms': {}}
+            self.docs_changed = True
+        # Only terms whose frequency changed move the postings.
+        old = doc['terms']
+        self.dirty |= self._shards_of(
+            t for t in set(old) | set(terms) if old.get(t) != terms.get(t))
+        if doc.get('title') != title:
+            self.docs_changed = True
+        doc.update({'hash': content_hash, 'title': title, 'terms': terms})
+
+    def _remove_unseen(self):
+        for url in [u for u in self.docs if u not in self.seen]:
+            self.dirty |= self._shards_of(self.docs.pop(url)['terms'])
+            self.docs_changed = True
+        # Reassign ids when more than half of them are unused.
+        if self.next_id > 2 * len(self.docs):
+            for i, url in enumerate(sorted(self.docs, key=lambda u: self.docs[u]['id'])):
+                self.docs[url]['id'] = i
+            self.next_id = len(self.docs)
+            self.dirty = set(range(self.shards))
+            self.docs_changed = True
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def save(self):
+        """Writes the changed shards and the document list. Returns the
+        number of shards written.
+        """
+        for url in sorted(u for u, doc in self.docs.iteritems() if doc['id'] is None):
+            self.docs[url]['id'] = self.next_id
+            self.next_id += 1
+        self._remove_unseen()
+        try:
+            os.makedirs(self.directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        for shard in range(self.shards):
+            if not os.path.exists(self._path('%02d.bin' % shard)):
+                self.dirty.add(shard)
+        if not os.path.exists(self._path('index.json')):
+            self.docs_changed = True
+
+        postings = dict((shard, {}) for shard in self.dirty)
+        if postings:
+            for doc in self.docs.itervalues():
+                for term, tf in doc['terms'].iteritems():
+                    terms = postings.get(self._shard(term))
+                    if terms is not None:
+                        terms.setdefault(term, []).append((doc['id'], tf))
+
+        for shard, terms in sorted(postings.items()):
+            data = bytearray()
+            table = {}
+            for term in sorted(terms):
+                encoded = encode_postings(sorted(terms[term]))
+                table[term] = [len(data), len(encoded), len(terms[term])]
+                data.extend(encoded)
+            _write(self._path('%02d.bin' % shard), bytes(data))
+            _write(self._path('%02d.json' % shard),
+                   json.dumps(table, separators=(',', ':'), sort_keys=True))
+
+        if self.docs_changed:
+            docs = [None] * self.next_id
+            for url, doc in self.docs.iteritems():
+                docs[doc['id']] = [url, doc['title']]
+            _write(self._path('index.json'), json.dumps({
+                'version': VERSION,
+                'shards': self.shards,
+                'docs': docs,
+            }, separators=(',', ':')))
+
+        written = len(postings)
+        self.seen = set()
+        self.dirty = set()
+        self.docs_changed = False
+        return written
+
+    def save_state(self):
+        """Writes the term counts of the saved index to state_path.
+
+        Later builds only write what changed since, so the state must
+        describe the index they start from. Don't save it for an index
+        that is discarded.
+        """
+        try:
+            os.makedirs(os.path.dirname(self.state_path))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        _write(self.state_path, json.dumps({
+            'version': VERSION,
+            'shards': self.shards,
+            'min_length': self.min_length,
+            'next_id': self.next_id,
+            'docs': self.docs,
+        }))
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+"""
+Byte sizes of the built pages, media and assets, checked against budgets.
+
+The size of each page is recorded with the files it makes a browser load,
+found in its html: src and srcset of images, scripts, media and embeds,
+stylesheets, icons and preloads. Of the candidates of an element, or of a
+picture element, only the largest is counted, that is the most a browser
+loads for it. Links to other pages are not counted.
+
+The report is written as JSON with the heaviest pages, media and assets
+and every budget that was exceeded.
+"""
+
+from __future__ import with_statement
+
+import os
+import re
+import json
+import urlparse
+
+# Budgets are given in kilobytes.
+BUDGETS = ('page', 'page_total', 'media', 'asset')
+
+_picture_re = re.compile(r'<picture\b.*?</picture\s*>', re.DOTALL | re.IGNORECASE)
+_element_re = re.compile(r'<(img|script|source|video|audio|embed|input|track|link)\b([^>]*)>', re.IGNORECASE)
+_attr_re = re.compile(r'''\b(src|srcset|href|poster|rel)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''', re.IGNORECASE)
+_loaded_rels = set(['stylesheet', 'icon', 'preload', 'modulepreload', 'apple-touch-icon'])
+
+
+class BudgetExceeded(Exception):
+    """ Raised when the built site is over one of its budgets.
+    """
+    def __init__(self, exceeded):
+        Exception.__init__(self, '{0} budgets exceeded'.format(len(exceeded)))
+        self.exceeded = exceeded
+
+
+def _candidates(attrs):
+    attrs = dict((m.group(1).lower(), m.group(2) or m.group(3) or m.group(4) or u'')
+                 for m in _attr_re.finditer(attrs))
+    urls = []
+    for name in ('src', 'poster', 'href'):
+        if attrs.get(name):
+            urls.append(attrs[name])
+    for candidate in attrs.get('srcset', u'').split(','):
+        candidate = candidate.strip()
+        if candidate and candidate.split()[0] not in urls:
+            urls.append(candidate.split()[0])
+    return attrs, urls
+
+
+def references(html):
+    """Returns the groups of urls referenced by html, a browser loads the
+    largest of each group at most.
+
+    >>> references(u'<link rel="stylesheet" href="/a.css"><link rel="next" href="/2/">'
+    ...            u'<img src="/s.jpg" srcset="/s.jpg 320w, /l.jpg 1024w"><a href="/b/">b</a>'
+    ...            u'<picture><source srcset="/p.webp"><img src="/p.jpg"></picture>')
+    [[u'/p.webp', u'/p.jpg'], [u'/a.css'], [u'/s.jpg', u'/l.jpg']]
+    """
+    groups = []
+
+    def picture(match):
+        urls = []
+        for element in _element_re.finditer(match.group(0)):
+            urls.extend(_candidates(element.group(2))[1])
+        if urls:
+            groups.append(urls)
+        return u''
+
+    html = _picture_re.sub(picture, html)
+    for element in _element_re.finditer(html):
+        attrs, urls = _candidates(element.group(2))
+        tag = element.group(1).lower()
+        if tag == 'link':
+            if not _loaded_rels.intersection(attrs.get('rel', u'').lower().split()):
+                continue
+        elif 'href' in attrs:
+            urls.remove(attrs['href'])
+        if urls:
+            groups.append(urls)
+    return groups
+
+
+def _local_path(base, url):
+    """Returns the path of url relative to the site root, or None if it is
+    on another host or inline.
+
+    >>> _local_path(u'/articles/a/index.html', u'../../assets/app.css?v=2')
+    u'/assets/app.css'
+    >>> _local_path(u'/index.html', u'//cdn.example.com/x.js') is None
+    True
+    """
+    url = urlparse.urljoin(base, url)
+    parts = urlparse.urlsplit(url)
+    if parts.scheme or parts.netloc or not parts.path:
+        return None
+    return urlparse.unquote(parts.path)
+
+
+class WeightReport(object):
+    """Collects the sizes of a build.
+
+    roots are the directories looked in for a referenced file that was not
+    recorded, in order. Sizes of files and pages are in bytes.
+    """
+    def __init__(self, roots, budgets=None):
+        self.roots = roots
+        self.budgets = budgets or {}
+        self.files = {'media': {}, 'asset': {}}
+        self.pages = {}
+
+    def add_file(self, kind, path, size):
+        """Records a media or asset file, path is relative to the site root.
+        """
+        self.files[kind][path] = size
+
+    def add_page(self, path, size, html):
+        """Records a page of size bytes with the references in html.
+        """
+        self.pages[path] = (size, references(html))
+
+    def size_of(self, path):
+        for files in self.files.values():
+            if path in files:
+                return files[path]
+        if path in self.pages:
+            return self.pages[path][0]
+        for root in self.roots:
+            try:
+                return os.path.getsize(os.path.join(root, path.lstrip('/')))
+            except OSError:
+                pass
+        return None
+
+    def _page(self, path):
+        size, groups = self.pages[path]
+        loaded = {}
+        missing = set()
+        for urls in groups:
+            largest = None
+            for url in urls:
+                local = _local_path(path, url)
+                if local is None:
+                    continue
+                if local.endswith('/'):
+                    local += 'index.html'
+                local_size = self.size_of(local)
+                if local_size is None:
+                    missing.add(local)
+                elif largest is None or local_size > largest[1]:
+                    largest = (local, local_size)
+            if largest is not None:
+                loaded[largest[0]] = largest[1]
+        return {
+            'url': path,
+            'bytes': size,
+            'total_bytes': size + sum(loaded.values()),
+            'references': sorted(loaded.items(), key=lambda r: -r[1]),
+            'missing': sorted(missing),
+        }
+
+    def exceeded(self, pages):
+        """Returns (budget, path, bytes, limit) for each budget exceeded.
+        """
+        over = []
+
+        def check(budget, path, size):
+            limit = self.budgets.get(budget)
+            if limit is not None and size > limit * 1024:
+                over.append((budget, path, size, limit * 1024))
+
+        for page in pages:
+            check('page', page['url'], page['bytes'])
+            check('page_total', page['url'], page['total_bytes'])
+        for kind, files in sorted(self.files.items()):
+            for path, size in files.iteritems():
+                check(kind, path, size)
+        return sorted(over, key=lambda o: (o[0], -o[2], o[1]))
+
+    def report(self, top=10):
+        """Returns the report, with the top heaviest of each kind.
+        """
+        pages = [self._page(path) for path in self.pages]
+
+        def heaviest(items, key):
+            return sorted(items, key=lambda i: (-i[key], i['url']))[:top]
+
+        report = {
+            'pages': len(pages),
+            'missing': sorted(set(m for p in pages for m in p['missing'])),
+            'total_bytes': sum(p['bytes'] for p in pages) + sum(
+                sum(files.values()) for files in self.files.values()),
+            'heaviest_pages': heaviest(pages, 'total_bytes'),
+            'exceeded': [{'budget': b, 'url': p, 'bytes': s, 'limit': l}
+                         for b, p, s, l in self.exceeded(pages)],
+        }
+        for kind, files in self.files.items():
+            report['heaviest_' + kind] = heaviest(
+                [{'url': p, 'bytes': s} for p, s in files.iteritems()], 'bytes')
+        return report
+
+    def save(self, path, top=10):
+        """Writes the report to path and returns it.
+        """
+        report = self.report(top)
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        os.rename(tmp, path)
+        return report
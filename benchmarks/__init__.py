@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for bakery.
+
+Synthetic sites are generated with `benchmarks.sitegen` and timed with
+`benchmarks.run`, run it from the repository root.
+
+    python -m benchmarks.run --pages 1000 --output results.json
+    python -m benchmarks.run --pages 1000 --baseline results.json
+"""
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measure the memory and sort time of resources on very large sites.
+
+Creates page and media resources in memory, the sources are not read,
+and reports the memory used per resource, the time to sort them by order
+and destination and the time to build a ResourceTree of them.
+
+    python -m benchmarks.resources --resources 100000
+"""
+
+from __future__ import with_statement
+
+import gc
+import os
+import sys
+import json
+import time
+import resource
+
+from bakery import bakery
+
+
+class _Loader(object):
+    """ Returns a front matter without reading source.
+    """
+    def load(self, source):
+        return u'', {u'title': u'Article ' + os.path.basename(source)}
+
+
+def _rss():
+    """ Return the resident set size of this process in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # Not linux, ru_maxrss only grows which is good enough here.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _sources(count, fanout=10):
+    """ Return count article sources spread over articles and two levels of
+    fanout sub directories below it.
+    """
+    sources = []
+    for i in range(count):
+        parts = [u'articles', u'section-%d' % (i % fanout), u'part-%d' % ((i // fanout) % fanout)]
+        sources.append(u'/pages/%s/article-%d.md' % (u'/'.join(parts[:i % 3 + 1]), i))
+    return sources
+
+
+def _timed(func, repeat):
+    runs = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        runs.append(time.time() - start)
+    return min(runs)
+
+
+def measure(count, tree_count, repeat=3):
+    config = bakery.Config(source_dir=u'/site', build_dir=u'/site/_out')
+    loader = _Loader()
+    sources = _sources(count)
+    results = {}
+    # Kept alive so that memory freed by one kind is not reused by the next.
+    kept = []
+
+    for name, create in (
+            ('page', lambda s: bakery.PageResource(config, s, loader=loader)),
+            ('media', lambda s: bakery.MediaResource(
+                config, u'/site/media/gallery-%d/%s.png' % (len(s) % 10, os.path.basename(s))))):
+        gc.collect()
+        before = _rss()
+        resources = [create(s) for s in sources]
+        # Read the derived paths once, like the build does.
+        for r in resources:
+            r.destination, r.belongs_to, r.belongs_to_parent
+        gc.collect()
+        results['%s_bytes' % name] = float(_rss() - before) / count
+        if name == 'page':
+            results['sort_order'] = _timed(
+                lambda: sorted(resources, key=lambda r: r.order), repeat)
+            results['sort_destination'] = _timed(
+                lambda: sorted(resources, key=lambda r: r.destination), repeat)
+            results['resource_tree'] = _timed(
+                lambda: bakery.ResourceTree(resources[:tree_count]), repeat)
+        kept.append(resources)
+    results['resources'] = count
+    results['tree_resources'] = tree_count
+    return results
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage="usage: %prog [options]")
+    _opt = parser.add_option
+    _opt("--resources", action="store", type="int", default=100000, help="number of resources [default: %default].")
+    _opt("--tree-resources", action="store", type="int", dest="tree_resources", default=100000, help="number of resources in the ResourceTree [default: %default].")
+    _opt("--repeat", action="store", type="int", default=3, help="number of timed runs [default: %default].")
+    _opt("-o", "--output", action="store", help="write results as JSON to this path.")
+    opt, args = parser.parse_args()
+
+    results = measure(opt.resources, min(opt.tree_resources, opt.resources), opt.repeat)
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    for name, value in sorted(results.items()):
+        sys.stdout.write('%-20s %12.4f\n' % (name, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+"""
+Run the bakery benchmarks.
+
+Times cold builds, warm builds and single file rebuilds of a synthetic
+site through `Site.build()` together with a set of microbenchmarks. The
+results are written as JSON and can be compared against a baseline from
+an earlier run.
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+
+from bakery import bakery
+from bakery import typogrify
+from benchmarks import sitegen
+
+BENCHMARKS = {}
+
+
+def benchmark(group):
+    """ Register a benchmark function in group.
+    """
+    def decorator(func):
+        BENCHMARKS.setdefault(group, []).append(func)
+        return func
+    return decorator
+
+
+def _quiet(x):
+    pass
+
+
+def timeit(func, repeat, setup=None):
+    """ Time func repeat times, setup is called before each run untimed.
+    """
+    runs = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        runs.append(time.time() - start)
+    return {
+        'best': min(runs),
+        'median': sorted(runs)[len(runs) // 2],
+        'runs': runs,
+    }
+
+
+def _site(env):
+    # The cache is kept in the generated site, away from the caller's cwd.
+    return bakery.Site(bakery.Config(env['config'], workers=env['workers'],
+                                     cache_dir=os.path.join(env['path'], u'.bakery-cache')))
+
+
+def _touch_one(env):
+    """ Modify a single article so the next build has a change to pick up.
+    """
+    path = os.path.join(env['path'], u'site', u'pages', u'articles', u'article-0.md')
+    with open(path, 'a') as f:
+        f.write('\nChanged.\n')
+
+
+@benchmark('build')
+def cold_build(env):
+    # Cold means without the output of earlier builds and without cache.
+    dirs = [os.path.join(env['path'], u'_out'), os.path.join(env['path'], u'.bakery-cache')]
+
+    def clean():
+        for d in dirs:
+            if os.path.isdir(d):
+                shutil.rmtree(d)
+    return timeit(lambda: _site(env).build(), env['repeat'], setup=clean)
+
+
+@benchmark('build')
+def warm_build(env):
+    _site(env).build()
+    return timeit(lambda: _site(env).build(), env['repeat'])
+
+
+@benchmark('build')
+def single_file_rebuild(env):
+    site = _site(env)
+    site.build()
+    return timeit(site.build, env['repeat'], setup=lambda: _touch_one(env))
+
+
+@benchmark('micro')
+def typogrify_page(env):
+    text = u'\n'.join(u'<p>%s</p>' % sitegen._paragraph(sitegen.random.Random(i))
+                      for i in range(20))
+    return timeit(lambda: [typogrify.typogrify(text) for i in range(10)], env['repeat'])
+
+
+def _markdown_pages():
+    return [u'# Page %d\n\n%s\n\n* one\n* two\n' % (
+        i, sitegen._paragraph(sitegen.random.Random(i), sentences=2)) for i in range(200)]
+
+
+@benchmark('micro')
+def markdown_module(env):
+    import markdown
+    pages = _markdown_pages()
+    return timeit(lambda: [markdown.markdown(p) for p in pages], env['repeat'])
+
+
+@benchmark('micro')
+def markdown_converter(env):
+    import markdown
+    pages = _markdown_pages()
+    md = markdown.Markdown()
+
+    def convert():
+        for p in pages:
+            md.reset()
+            md.convert(p)
+    return timeit(convert, env['repeat'])
+
+
+@benchmark('micro')
+def resource_tree(env):
+    site = _site(env)
+    site.read_directories()
+    return timeit(lambda: bakery.ResourceTree(site.articles), env['repeat'])
+
+
+@benchmark('micro')
+def paginator(env):
+    site = _site(env)
+    site.read_directories()
+    resources = list(site.resources[:])
+
+    def reset():
+        site.resources = list(resources)
+    paginator = bakery.Paginator(site)
+
+    def paginate():
+        paginator.paginate_all(site.config.pagination.items())
+    return timeit(paginate, env['repeat'], setup=reset)
+
+
+def compare(results, baseline):
+    """ Return lines comparing the median of results against baseline.
+    """
+    lines = []
+    for name, result in sorted(results['results'].items()):
+        base = baseline['results'].get(name)
+        if base is None:
+            lines.append('%-32s %10.4fs %10s' % (name, result['median'], 'new'))
+            continue
+        ratio = result['median'] / base['median'] if base['median'] else 0.0
+        lines.append('%-32s %10.4fs %10.4fs %7.2fx' % (
+            name, result['median'], base['median'], ratio))
+    return lines
+
+
+def run(groups, repeat=3, workers=1, **site_options):
+    path = tempfile.mkdtemp(prefix='bakery-bench-')
+    try:
+        env = {
+            'path': path,
+            'repeat': repeat,
+            'workers': workers,
+            'config': sitegen.generate(path, **site_options),
+        }
+        results = {}
+        for group in groups:
+            for func in BENCHMARKS.get(group, []):
+                name = '%s.%s' % (group, func.__name__)
+                sys.stderr.write('>> %s\n' % name)
+                results[name] = func(env)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+    return {
+        'meta': {
+            'bakery': bakery.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'repeat': repeat,
+            'workers': workers,
+            'site': site_options,
+        },
+        'results': results,
+    }
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage="usage: %prog [options]")
+    _opt = parser.add_option
+    _opt("--group", action="append", dest="groups", help="benchmark group to run, build or micro [default: all].")
+    _opt("--repeat", action="store", type="int", default=3, help="number of timed runs [default: %default].")
+    _opt("--workers", action="store", type="int", default=1, help="number of render worker processes [default: %default].")
+    _opt("--pages", action="store", type="int", default=200, help="number of articles [default: %default].")
+    _opt("--depth", action="store", type="int", default=2, help="depth of article directories [default: %default].")
+    _opt("--fanout", action="store", type="int", default=3, help="sub directories per directory [default: %default].")
+    _opt("--per-page", action="store", type="int", default=10, dest="per_page", help="resources per page [default: %default].")
+    _opt("--partials", action="store", type="int", default=3, help="number of partials [default: %default].")
+    _opt("--images", action="store", type="int", default=10, help="number of media images [default: %default].")
+    _opt("--assets", action="store", type="int", default=10, help="number of assets [default: %default].")
+    _opt("--image-variants", action="store_true", dest="image_variants", default=False, help="configure scaled image variants, requires PIL.")
+    _opt("--site-partials", action="store_true", dest="site_partials", default=False, help="configure the partials as site scoped.")
+    _opt("-o", "--output", action="store", help="write results as JSON to this path.")
+    _opt("-b", "--baseline", action="store", help="compare results with this JSON file.")
+    opt, args = parser.parse_args()
+
+    bakery._stdout = _quiet
+    groups = opt.groups or sorted(BENCHMARKS)
+    results = run(groups, repeat=opt.repeat, workers=opt.workers, pages=opt.pages, depth=opt.depth,
+                  fanout=opt.fanout, per_page=opt.per_page,
+                  partials=opt.partials, images=opt.images,
+                  assets=opt.assets, image_variants=opt.image_variants,
+                  site_partials=opt.site_partials)
+
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if opt.baseline:
+        with open(opt.baseline) as f:
+            baseline = json.load(f)
+        lines = compare(results, baseline)
+    else:
+        lines = ['%-32s %10.4fs' % (name, r['median'])
+                 for name, r in sorted(results['results'].items())]
+    sys.stdout.write('\n'.join(lines) + '\n')
+
+
+if __name__ == '__main__':
+    main()
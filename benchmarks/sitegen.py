@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic site generator.
+
+Creates a bakery site with a configurable number of pages spread over
+nested article directories, together with pagination, partials, media
+images and assets. The output is deterministic for a given seed so that
+results from different runs can be compared.
+"""
+
+from __future__ import with_statement
+
+import os
+import random
+import struct
+import zlib
+import codecs
+
+WORDS = (
+    u'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod '
+    u'tempor incididunt ut labore et dolore magna aliqua ut enim ad minim '
+    u'veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea '
+    u'commodo consequat duis aute irure in reprehenderit voluptate velit esse '
+    u'cillum fugiat nulla pariatur excepteur sint occaecat cupidatat non '
+    u'proident sunt culpa qui officia deserunt mollit anim id est laborum'
+).split()
+
+LAYOUT = u"""<!doctype html>
+<html>
+  <head>
+    <title>{{page.title}}</title>
+    <link href="/assets/css/style-0.css" rel="stylesheet">
+  </head>
+  <body>
+    {{> header}}
+    {{> navigation}}
+    <article>
+      {{& page.content}}
+    </article>
+    {{#pager}}
+    <p>Page {{pager.page}} of {{pager.total_pages}}</p>
+    {{/pager}}
+%(partials)s
+    {{> footer}}
+  </body>
+</html>
+"""
+
+HEADER = u'<header><h1>{{site.name}}</h1></header>\n'
+FOOTER = u'<footer><p>&copy; {{site.name}}</p></footer>\n'
+NAVIGATION = u"""<nav>
+  <ul>
+  {{#site.articles.all}}
+    <li><a href="{{url}}">{{title}}</a></li>
+  {{/site.articles.all}}
+  </ul>
+</nav>
+"""
+PARTIAL = u'<aside class="partial-%(index)d"><p>{{site.name}} %(text)s</p></aside>\n'
+
+INDEX = u"""---
+title: %(title)s
+---
+<h1>{{title}}</h1>
+<ul>
+{{#pager.resources}}
+  <li><a href="{{url}}">{{title}}</a></li>
+{{/pager.resources}}
+</ul>
+"""
+
+ARTICLE = u"""---
+title: %(title)s
+tags: [%(tags)s]
+---
+# {{title}}
+
+%(body)s
+"""
+
+
+def _sentence(rnd, words=12):
+    s = u' '.join(rnd.choice(WORDS) for i in range(words))
+    return s[0].upper() + s[1:] + u'.'
+
+
+def _paragraph(rnd, sentences=5):
+    text = u' '.join(_sentence(rnd) for i in range(sentences))
+    # Give typogrify something to work with.
+    return text.replace(u' ut ', u' "ut" ', 1).replace(u' et ', u' & ', 1) \
+        .replace(u' in ', u' IN ', 1).replace(u' id ', u' -- ', 1)
+
+
+def _write(path, content):
+    d = os.path.dirname(path)
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    with codecs.open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+
+
+def png(width, height, rgb):
+    """ Return the bytes of a solid color RGB PNG.
+
+    Written by hand so that a site can be generated without PIL.
+    """
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data \
+            + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    row = b'\x00' + struct.pack('BBB', *rgb) * width
+    return b'\x89PNG\r\n\x1a\n' \
+        + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) \
+        + chunk(b'IDAT', zlib.compress(row * height)) \
+        + chunk(b'IEND', b'')
+
+
+def _directories(depth, fanout):
+    """ Return the nested article directories, parents before children.
+    """
+    dirs = [u'']
+    level = [u'']
+    for d in range(depth):
+        level = [os.path.join(p, u'section-%d-%d' % (d, i))
+                 for p in level for i in range(fanout)]
+        dirs.extend(level)
+    return dirs
+
+
+def generate(path, pages=100, depth=2, fanout=3, per_page=10, partials=3,
+             images=10, galleries=2, image_size=(64, 48), assets=10,
+             image_variants=False, site_partials=False, seed=0):
+    """ Generate a site in path and return the path to its config.
+
+    pages is the number of markdown articles, they are spread evenly over
+    the nested directories created from depth and fanout. Each directory
+    gets a paginated index.html. With site_partials all partials are
+    configured as site scoped.
+    """
+    rnd = random.Random(seed)
+    path = os.path.abspath(path)
+    source_dir = os.path.join(path, u'site')
+    pages_dir = os.path.join(source_dir, u'pages', u'articles')
+
+    partial_names = [u'partial-%d' % i for i in range(partials)]
+    _write(os.path.join(source_dir, u'layouts', u'default.html'), LAYOUT % {
+        'partials': u''.join(u'    {{> %s}}\n' % n for n in partial_names)})
+    _write(os.path.join(source_dir, u'layouts', u'header.html'), HEADER)
+    _write(os.path.join(source_dir, u'layouts', u'footer.html'), FOOTER)
+    _write(os.path.join(source_dir, u'layouts', u'navigation.html'), NAVIGATION)
+    for i, name in enumerate(partial_names):
+        _write(os.path.join(source_dir, u'layouts', name + u'.html'),
+               PARTIAL % {'index': i, 'text': _sentence(rnd)})
+
+    dirs = _directories(depth, fanout)
+    pagination = {}
+    for i, d in enumerate(dirs):
+        _write(os.path.join(pages_dir, d, u'index.html'),
+               INDEX % {'title': u'Index %d' % i})
+        destination = u'/' + u'/'.join([u'articles', d]).strip(u'/')
+        pagination[u'articles-%d' % i] = {
+            u'pattern': destination + u'/*.html',
+            u'per_page': per_page,
+        }
+
+    for i in range(pages):
+        d = dirs[i % len(dirs)]
+        body = u'\n\n'.join(_paragraph(rnd) for p in range(3))
+        tags = u', '.join(rnd.sample(WORDS[:20], 2))
+        _write(os.path.join(pages_dir, d, u'article-%d.md' % i), ARTICLE % {
+            'title': u'Article %d' % i, 'tags': tags, 'body': body})
+
+    for i in range(images):
+        gallery = os.path.join(source_dir, u'media', u'gallery-%d' % (i % max(galleries, 1)))
+        if not os.path.isdir(gallery):
+            os.makedirs(gallery)
+        color = (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255))
+        with open(os.path.join(gallery, u'image-%d.png' % i), 'wb') as f:
+            f.write(png(image_size[0], image_size[1], color))
+
+    for i in range(assets):
+        if i % 2:
+            _write(os.path.join(source_dir, u'assets', u'js', u'script-%d.js' % i),
+                   u'var a%d = function () { return %d; };\n' % (i, i) * 50)
+        else:
+            _write(os.path.join(source_dir, u'assets', u'css', u'style-%d.css' % i),
+                   u'.c%d { margin: 0 %dpx; }\n' % (i, i) * 50)
+
+    config = [
+        u'source_dir: %s' % source_dir,
+        u'build_dir: %s' % os.path.join(path, u'_out'),
+        u'site_context:',
+        u'  name: Benchmark',
+        u'pagination:',
+    ]
+    for name in sorted(pagination):
+        config.append(u'  %s:' % name)
+        config.append(u'    pattern: %s' % pagination[name][u'pattern'])
+        config.append(u'    per_page: %d' % pagination[name][u'per_page'])
+    if site_partials:
+        config.append(u'site_partials:')
+        config.extend(u'  - %s' % n for n in [u'header', u'navigation', u'footer'] + partial_names)
+    if image_variants:
+        config.extend([
+            u'media:',
+            u'  image:',
+            u'    small:',
+            u'      width: 32',
+            u'      height: 32',
+            u'    medium:',
+            u'      width: 48',
+            u'      height: 48',
+        ])
+    config_path = os.path.join(path, u'config.yaml')
+    _write(config_path, u'\n'.join(config) + u'\n')
+    return config_path
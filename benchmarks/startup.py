@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measure the startup time of the bakery command line.
+
+Each command is run in a fresh interpreter, the time reported is the best
+of the runs together with the heavy modules the command imported. With
+--check it exits with a non-zero status if `bakery --version` imports any
+of the rendering stack.
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --check
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+from benchmarks import sitegen
+
+# Modules that should only be imported by the phases that need them.
+HEAVY = [
+    'pystache',
+    'markdown',
+    'yaml',
+    'bakery.typogrify',
+    'multiprocessing',
+    'Image',
+    'PIL',
+]
+
+# Runs bakery.main() with the given arguments and prints the heavy modules
+# that were imported as JSON on the last line.
+SCRIPT = """
+import sys, json
+heavy = json.loads(sys.argv[2])
+sys.argv = ['bakery'] + json.loads(sys.argv[1])
+from bakery import bakery
+bakery._stdout = lambda x: None
+try:
+    bakery.main()
+except SystemExit:
+    pass
+sys.stdout.write('\\n' + json.dumps([m for m in heavy if m in sys.modules]) + '\\n')
+"""
+
+COMMANDS = [
+    ('version', ['--version']),
+    ('help', ['--help']),
+    ('bootstrap', ['--bootstrap']),
+    ('noop_build', ['--build', '-c', '{config}']),
+]
+
+
+def run_command(args, cwd):
+    """ Run bakery with args, return the time taken and the heavy modules
+    it imported.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [root, env.get('PYTHONPATH')]))
+    start = time.time()
+    out = subprocess.Popen(
+        [sys.executable, '-c', SCRIPT, json.dumps(args), json.dumps(HEAVY)],
+        cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    ).communicate()[0]
+    elapsed = time.time() - start
+    return elapsed, json.loads(out.strip().splitlines()[-1])
+
+
+def measure(repeat=5):
+    path = tempfile.mkdtemp(prefix='bakery-startup-')
+    try:
+        # An empty site, building it has nothing to render.
+        config = sitegen.generate(os.path.join(path, 'site'), pages=0,
+                                  depth=0, images=0, assets=0, partials=0)
+        os.remove(os.path.join(path, 'site', 'site', 'pages', 'articles', 'index.html'))
+        results = {}
+        for name, args in COMMANDS:
+            args = [a.format(config=config) for a in args]
+            runs = []
+            for i in range(repeat):
+                cwd = tempfile.mkdtemp(dir=path)
+                elapsed, imported = run_command(args, cwd)
+                runs.append(elapsed)
+            results[name] = {
+                'best': min(runs),
+                'median': sorted(runs)[len(runs) // 2],
+                'runs': runs,
+                'imported': imported,
+            }
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+    return results
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage="usage: %prog [options]")
+    _opt = parser.add_option
+    _opt("--repeat", action="store", type="int", default=5, help="number of runs per command [default: %default].")
+    _opt("--check", action="store_true", default=False, help="fail if --version imports the rendering stack.")
+    _opt("-o", "--output", action="store", help="write results as JSON to this path.")
+    opt, args = parser.parse_args()
+
+    if opt.check:
+        elapsed, imported = run_command(['--version'], os.getcwd())
+        if imported:
+            sys.stderr.write('bakery --version imported {0}\n'.format(', '.join(imported)))
+            sys.exit(1)
+        sys.stdout.write('bakery --version imports none of the rendering stack\n')
+        sys.exit(0)
+
+    results = measure(opt.repeat)
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    for name, r in sorted(results.items()):
+        sys.stdout.write('%-12s %8.4fs  %s\n' % (name, r['best'], ', '.join(r['imported']) or '-'))
+
+
+if __name__ == '__main__':
+    main()